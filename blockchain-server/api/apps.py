@@ -1,6 +1,47 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        if not _is_serving_process():
+            return
+
+        from . import views
+
+        # Only processes that serve requests restore the node, tests and shells start from genesis
+        if settings.SNAPSHOT_ENABLED:
+            views.restore_snapshot()
+
+        if settings.BLOCK_PRODUCER_ENABLED:
+            views.block_producer.start()
+
+        if settings.SNAPSHOT_ENABLED:
+            views.snapshotter.start()
+            # A node restored from a snapshot only needs the blocks mined since
+            if views.blockchain.nodes:
+                views.gossip.request_pull(views.blockchain)
+
+
+def _is_serving_process() -> bool:
+    """
+    Check if this process serves requests
+
+    Only the WSGI and ASGI entry points, which set API_SERVING_PROCESS, and
+    runserver serve requests. Management commands, tests, scripts and shells
+    that import the app do not start its background threads.
+    """
+    if os.environ.get('API_SERVING_PROCESS') == '1':
+        return True
+
+    if os.path.basename(sys.argv[0]) != 'manage.py' or len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        return False
+
+    # With the autoreloader the server runs in a child process
+    return '--noreload' in sys.argv or os.environ.get('RUN_MAIN') == 'true'
@@ -0,0 +1,241 @@
+import functools
+import json
+from hashlib import sha256
+from typing import List, Dict, Any, Optional, Callable, Tuple
+from .merkle import merkle_root
+
+# Blocks are pickled to the process pool, whose workers import this module
+# without Django being set up, so it must not import the app's models
+
+
+def _reports_change(method: Callable) -> Callable:
+    """Tell the block owning a transaction container once method changed it"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._block._transactions_changed()
+        return result
+    return wrapper
+
+
+class _Transaction(dict):
+    """A transaction of a block, telling the block when it is edited in place"""
+    __slots__ = ('_block',)
+
+    def __init__(self, block: 'Block', fields: Dict):
+        super().__init__(fields)
+        self._block = block
+
+    def __reduce__(self):
+        # Pickled and copied as a plain dict, the block it goes into wraps it again
+        return (dict, (dict(self),))
+
+    __setitem__ = _reports_change(dict.__setitem__)
+    __delitem__ = _reports_change(dict.__delitem__)
+    __ior__ = _reports_change(dict.__ior__)
+    clear = _reports_change(dict.clear)
+    pop = _reports_change(dict.pop)
+    popitem = _reports_change(dict.popitem)
+    setdefault = _reports_change(dict.setdefault)
+    update = _reports_change(dict.update)
+
+
+class _Transactions(list):
+    """The transactions of a block, telling the block when they are edited in place"""
+    __slots__ = ('_block',)
+
+    def __init__(self, block: 'Block', transactions: List[Dict] = ()):
+        super().__init__(_Transaction(block, transaction) for transaction in transactions)
+        self._block = block
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def _wrap(self, transactions: List[Dict]) -> List[_Transaction]:
+        return [_Transaction(self._block, transaction) for transaction in transactions]
+
+    @_reports_change
+    def __setitem__(self, key, value):
+        super().__setitem__(key, self._wrap(value) if isinstance(key, slice) else _Transaction(self._block, value))
+
+    @_reports_change
+    def __iadd__(self, transactions):
+        return super().__iadd__(self._wrap(transactions))
+
+    @_reports_change
+    def append(self, transaction):
+        super().append(_Transaction(self._block, transaction))
+
+    @_reports_change
+    def extend(self, transactions):
+        super().extend(self._wrap(transactions))
+
+    @_reports_change
+    def insert(self, position, transaction):
+        super().insert(position, _Transaction(self._block, transaction))
+
+    __delitem__ = _reports_change(list.__delitem__)
+    __imul__ = _reports_change(list.__imul__)
+    clear = _reports_change(list.clear)
+    pop = _reports_change(list.pop)
+    remove = _reports_change(list.remove)
+    reverse = _reports_change(list.reverse)
+    sort = _reports_change(list.sort)
+
+
+class Block:
+    """
+    A block of the chain
+
+    Blocks use __slots__ and cache their canonical encoding, hash and
+    transactions merkle root. Assigning a field, or editing the transactions
+    or one of them in place, drops the cache and tells the chain holding the
+    block, which checks the block again.
+    """
+    FIELDS = ('index', 'transactions', 'timestamp', 'previous_hash', 'nonce', 'blockhash', 'merkle_root')
+    __slots__ = FIELDS + ('_encoding', '_hash', '_transactions_root', '_observer')
+
+    def __init__(self, index: int, transactions: List[Dict], timestamp: Any, 
+                 previous_hash: str, nonce: int = 0, blockhash: str = '0',
+                 merkle_root: Optional[str] = None):
+        # Called with the block whenever one of its fields is assigned
+        self._observer: Optional[Callable[['Block'], None]] = None
+        self.index = index
+        self.transactions = transactions
+        self.timestamp = timestamp
+        self.previous_hash = previous_hash
+        self.nonce = nonce
+        self.blockhash = blockhash
+        self.merkle_root = merkle_root
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name == 'transactions':
+            value = _Transactions(self, value)
+        object.__setattr__(self, name, value)
+
+        if name.startswith('_'):
+            return
+
+        # The hash is always computed with a '0' blockhash, so setting it keeps the cache
+        if name != 'blockhash':
+            object.__setattr__(self, '_encoding', None)
+            object.__setattr__(self, '_hash', None)
+            if name == 'transactions':
+                object.__setattr__(self, '_transactions_root', None)
+
+        if self._observer is not None:
+            self._observer(self)
+
+    def _transactions_changed(self) -> None:
+        """Drop the caches and tell the chain after the transactions were edited in place"""
+        object.__setattr__(self, '_encoding', None)
+        object.__setattr__(self, '_hash', None)
+        object.__setattr__(self, '_transactions_root', None)
+        if self._observer is not None:
+            self._observer(self)
+
+    def __reduce__(self):
+        # Pickle the fields only, the caches are rebuilt and the observer stays behind
+        return (Block, tuple(getattr(self, field) for field in self.FIELDS))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the fields of the block as a dict"""
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def header(self) -> Dict[str, Any]:
+        """Get the block without its transactions"""
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previous_hash': self.previous_hash,
+            'nonce': self.nonce,
+            'merkle_root': self.merkle_root,
+            'blockhash': self.blockhash
+        }
+
+    def hash_fields(self) -> Dict[str, Any]:
+        """
+        Get the fields covered by the block hash
+
+        The blockhash itself is always hashed as '0'. A block that carries a
+        merkle root is hashed over its header alone, so the header can be
+        verified without the transactions. Blocks without one are hashed over
+        all their fields, transactions included.
+        """
+        fields = {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previous_hash': self.previous_hash,
+            'nonce': self.nonce,
+            'blockhash': '0'
+        }
+        if self.merkle_root is None:
+            fields['transactions'] = self.transactions
+        else:
+            fields['merkle_root'] = self.merkle_root
+        return fields
+
+    def encode(self) -> bytes:
+        """Get the canonical encoding the block hash is computed over"""
+        if self._encoding is None:
+            self._encoding = json.dumps(self.hash_fields(), sort_keys=True).encode()
+        return self._encoding
+
+    def compute_hash(self) -> str:
+        """Compute SHA-256 hash of the block"""
+        if self._hash is None:
+            self._hash = sha256(self.encode()).hexdigest()
+        return self._hash
+
+    def seal(self, nonce: int, block_hash: str) -> None:
+        """Set the nonce found by the proof of work along with the hash it gives"""
+        self.nonce = nonce
+        self._hash = block_hash
+
+    def transactions_root(self) -> str:
+        """Compute the merkle root of the block's transactions"""
+        if self._transactions_root is None:
+            self._transactions_root = merkle_root(self.transactions)
+        return self._transactions_root
+
+    def has_valid_merkle_root(self) -> bool:
+        """Check if the merkle root, when there is one, matches the transactions"""
+        return self.merkle_root is None or self.merkle_root == self.transactions_root()
+
+    def is_valid_proof(self, block_hash: str, difficulty: int, audit: bool = False) -> bool:
+        """
+        Check if block_hash is the hash of the block and satisfies the difficulty
+
+        An audit recomputes the merkle root and the hash from the fields
+        instead of using the caches, so it also catches edits the caches
+        cannot see, such as a value nested inside a transaction.
+        """
+        # Check if hash meets difficulty requirement
+        if not block_hash.startswith('0' * difficulty):
+            return False
+
+        if audit:
+            if self.merkle_root is not None and self.merkle_root != merkle_root(self.transactions):
+                return False
+            return block_hash == sha256(json.dumps(self.hash_fields(), sort_keys=True).encode()).hexdigest()
+            
+        # Check if the header commits to the block's transactions
+        if not self.has_valid_merkle_root():
+            return False
+            
+        # Check if hash matches block's computed hash
+        return block_hash == self.compute_hash()
+
+    @staticmethod
+    def from_json(block_json: Dict) -> 'Block':
+        """Create a Block instance from JSON data"""
+        return Block(**block_json)
+
+
+def first_invalid_proof(chunk: Tuple[int, List[Block], int]) -> Optional[int]:
+    """Find the chain position of the first block of a chunk with an invalid proof, runs in a pool worker"""
+    start, blocks, difficulty = chunk
+    for offset, block in enumerate(blocks):
+        if not block.is_valid_proof(block.blockhash, difficulty, audit=True):
+            return start + offset
+    return None
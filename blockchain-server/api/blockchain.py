@@ -1,49 +1,224 @@
 import datetime
-import json
 import logging
-from hashlib import sha256
-from typing import List, Set, Dict, Any, Optional
+from collections import Counter
+from typing import List, Set, Dict, Any, Optional, Tuple, NamedTuple
 from .models import IBlockchain, Block as BlockModel
+from concurrent.futures.process import BrokenProcessPool
+from .block import Block, first_invalid_proof
+from .pow import ProofOfWork, map_on_pool
+from .mempool import Mempool
+from .writer import ChainWriter, on_writer
 
 logger = logging.getLogger(__name__)
 
-class Block:
-    def __init__(self, index: int, transactions: List[Dict], timestamp: Any, 
-                 previous_hash: str, nonce: int = 0, blockhash: str = '0'):
-        self.index = index
-        self.transactions = transactions
-        self.timestamp = timestamp
-        self.previous_hash = previous_hash
-        self.nonce = nonce
-        self.blockhash = blockhash
 
-    def compute_hash(self) -> str:
-        """Compute SHA-256 hash of the block"""
-        block_string = json.dumps(self.__dict__, sort_keys=True)
-        return sha256(block_string.encode()).hexdigest()
+class ChainState(NamedTuple):
+    """
+    Consistent read-only view of a chain, published by its writer after every mutation
 
-    @staticmethod
-    def from_json(block_json: Dict) -> 'Block':
-        """Create a Block instance from JSON data"""
-        return Block(**block_json)
+    chain is a tuple of the chain's blocks as they were published, so it
+    stays the same while the writer moves the chain on.
+    """
+    chain: Tuple[Block, ...]
+    length: int
+    tally: Dict[str, int]
+
+    @property
+    def last_block(self) -> Block:
+        """Get the most recent block of the state"""
+        if not self.length:
+            raise ValueError("Chain is empty")
+        return self.chain[self.length - 1]
+
+    def blocks(self, start: int = 0, stop: Optional[int] = None) -> List[Block]:
+        """Get the blocks of the state from start up to stop (exclusive)"""
+        stop = self.length if stop is None else min(stop, self.length)
+        return self.chain[start:stop]
 
 
 class BlockchainInMemory(IBlockchain):
+    """
+    Blockchain held in memory
+
+    Every mutation of the chain and the mempool runs on the chain's writer
+    thread, so request threads never change it at the same time. Once a
+    mutation is done the writer publishes a new ChainState, which readers
+    take from state without waiting for the writer.
+    """
     # Class constants
     DIFFICULTY = 4
+    # Maximum number of pending transactions packed into one block
+    MAX_BLOCK_TRANSACTIONS = 500
+    # Chains at least this long are validated on the process pool...
+    PARALLEL_VERIFY_MIN_BLOCKS = 2000
+    # ...in chunks of this many blocks per task
+    PARALLEL_VERIFY_CHUNK_SIZE = 500
     
     def __init__(self):
-        self.unconfirmed_transactions: List[Dict] = []
+        self.unconfirmed_transactions: Mempool = Mempool(self.MEMPOOL_CAPACITY)
         self.chain: List[Block] = []
         self.already_voted: Set[str] = set()
+        # Running count of confirmed votes per candidate
+        self.tally: Counter = Counter()
+        # Lookups into the chain, the chain list itself maps heights to blocks
+        self._blocks_by_hash: Dict[str, Block] = {}
+        self._vote_index: Dict[str, int] = {}
         self.nodes: Set[str] = set()
         self.is_mining: bool = False
+        # Every block up to this height is known to be valid...
+        self._verified_height: int = -1
+        # ...except for the ones assigned a field since they were verified
+        self._dirty: Set[int] = set()
+        self._writer = ChainWriter()
+        # The chain list the published tuple was copied from
+        self._published_list: List[Block] = self.chain
+        self.state: ChainState = ChainState((), 0, {})
 
+    def _publish(self) -> None:
+        """Publish the current chain to readers, on the writer thread"""
+        chain = self.state.chain
+        # Most mutations only touch the mempool. The chain list is only ever appended
+        # to or replaced, so the tuple is rebuilt only when either happened
+        if self.chain is not self._published_list or len(self.chain) != len(chain):
+            chain = tuple(self.chain)
+            self._published_list = self.chain
+        self.state = ChainState(chain, len(chain), dict(self.tally))
+
+    @on_writer
     def create_genesis_block(self) -> None:
         """Create the first block in the chain"""
         genesis_block = Block(0, [], 0, "0")
         genesis_block.blockhash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
+        self._append(genesis_block)
+
+    @on_writer
+    def replace_chain(self, chain: List[Block], verified: bool = False) -> None:
+        """
+        Replace the whole chain
+
+        Args:
+            chain: The new chain
+            verified: True if the caller already checked the chain's validity
+        """
+        self.chain = []
+        self._verified_height = -1
+        self._dirty = set()
+        self.already_voted = set()
+        self.tally = Counter()
+        self._blocks_by_hash = {}
+        self._vote_index = {}
+        for block in chain:
+            self._append(block, verified)
+            self._record_votes(block)
+
+    @on_writer
+    def reset(self) -> None:
+        """Drop every block and start again from a new genesis block"""
+        self.replace_chain([])
+        self.create_genesis_block()
+
+    @on_writer
+    def replace_suffix(self, ancestor_height: int, blocks: List[Block], expected_length: Optional[int] = None) -> bool:
+        """
+        Replace the blocks above a common ancestor with already validated ones
+
+        Only the dropped and the new blocks are touched, so the cost does not
+        grow with the length of the chain. Blocks fetched while the chain
+        changed are dropped, the next sync starts again from the new chain.
+
+        Args:
+            ancestor_height: Height of the last block to keep
+            blocks: The validated blocks following the ancestor
+            expected_length: Length of the chain the blocks were fetched for
+
+        Returns:
+            bool: True if the blocks replaced the suffix
+        """
+        if expected_length is not None and len(self.chain) != expected_length:
+            logger.warning("Dropping blocks fetched for a chain that changed meanwhile")
+            return False
+        if ancestor_height >= len(self.chain) or (blocks and blocks[0].previous_hash != self.chain[ancestor_height].blockhash):
+            logger.warning(f"Dropping blocks that do not follow block #{ancestor_height}")
+            return False
+
+        removed = self.chain[ancestor_height + 1:]
+        if removed:
+            # A new list, so publishing sees the change even when the length stays the same
+            self.chain = self.chain[:ancestor_height + 1]
+        self._verified_height = min(self._verified_height, ancestor_height)
+
+        # Mutated blocks no longer hold what was counted when they were appended
+        if any(block.index in self._dirty for block in removed):
+            self._dirty = {index for index in self._dirty if index <= ancestor_height}
+            self._rebuild_indexes()
+        else:
+            for block in removed:
+                self._forget_votes(block)
+                self._blocks_by_hash.pop(block.blockhash, None)
+
+        for block in blocks:
+            self._append(block)
+            self._record_votes(block)
+        return True
+
+    def _rebuild_indexes(self) -> None:
+        """Rebuild the lookups and the tally from the chain"""
+        self.already_voted = set()
+        self.tally = Counter()
+        self._blocks_by_hash = {}
+        self._vote_index = {}
+        for block in self.chain:
+            self._blocks_by_hash[block.blockhash] = block
+            self._record_votes(block)
+
+    def _append(self, block: Block, verified: bool = True) -> None:
+        """Append a block to the chain and watch it for mutations"""
+        self.chain.append(block)
+        self._blocks_by_hash[block.blockhash] = block
+        block._observer = self._mark_dirty
+        # A verified block appended right after the verified part extends it
+        if verified and self._verified_height == block.index - 1:
+            self._verified_height = block.index
+
+    def _record_votes(self, block: Block) -> None:
+        """Add every voter of the block to the already voted set and count their votes"""
+        for transaction in block.transactions:
+            if 'voterhash' in transaction:
+                self.already_voted.add(transaction['voterhash'])
+                # The vote may also be pending here when it was gossiped to several nodes
+                self.unconfirmed_transactions.remove(transaction['voterhash'])
+                self._vote_index[transaction['voterhash']] = block.index
+            if 'candidate' in transaction:
+                self.tally[transaction['candidate']] += 1
+
+    def _forget_votes(self, block: Block) -> None:
+        """Undo _record_votes for a block dropped from the chain"""
+        for transaction in block.transactions:
+            if 'voterhash' in transaction:
+                self.already_voted.discard(transaction['voterhash'])
+                self._vote_index.pop(transaction['voterhash'], None)
+            if 'candidate' in transaction:
+                self.tally[transaction['candidate']] -= 1
+                if self.tally[transaction['candidate']] <= 0:
+                    del self.tally[transaction['candidate']]
+
+    @on_writer
+    def update_block(self, index: int, **fields: Any) -> None:
+        """
+        Assign fields of the block at a height of the chain
+
+        Nodes never change their blocks, this is how tests and the tamper
+        endpoint do. The block is marked as mutated, so the next validity
+        check looks at it again.
+        """
+        block = self.chain[index]
+        for name, value in fields.items():
+            setattr(block, name, value)
+
+    @on_writer
+    def _mark_dirty(self, block: Block) -> None:
+        """Record that a block of the chain was mutated"""
+        self._dirty.add(block.index)
 
     @property
     def last_block(self) -> Block:
@@ -52,14 +227,39 @@ class BlockchainInMemory(IBlockchain):
             raise ValueError("Chain is empty")
         return self.chain[-1]
 
+    def block_at(self, index: int) -> Optional[Block]:
+        """Get the block at a height of the chain"""
+        state = self.state
+        if 0 <= index < state.length:
+            return state.chain[index]
+        return None
+
+    def block_by_hash(self, blockhash: str) -> Optional[Block]:
+        """Get the block of the chain with the given hash"""
+        block = self._blocks_by_hash.get(blockhash)
+        # A tampered block keeps its old entry but no longer matches it
+        if block is None or block.blockhash != blockhash:
+            return None
+        return block
+
+    def vote_block(self, voter_hash: str) -> Optional[Block]:
+        """Get the block of the chain holding a voter's vote"""
+        index = self._vote_index.get(voter_hash)
+        if index is None:
+            return None
+        return self.block_at(index)
+
+    @on_writer
     def add_peer(self, peer: str) -> None:
         """Add a new peer node to the network"""
         if not peer:
             logger.warning("Attempted to add empty peer")
             return
-        self.nodes.add(peer)
+        # Readers iterate over the set without the writer, it is replaced rather than changed
+        self.nodes = self.nodes | {peer}
         logger.info(f"Added peer: {peer}")
 
+    @on_writer
     def add_block(self, block: Block, proof: str) -> bool:
         """
         Add a block to the chain if it's valid
@@ -91,15 +291,49 @@ class BlockchainInMemory(IBlockchain):
 
         # If we get here, the block is valid
         block.blockhash = proof
-        self.chain.append(block)
+        self._append(block)
         
-        # Add voter to already voted set if transactions exist
-        if block.transactions and 'voterhash' in block.transactions[0]:
-            self.already_voted.add(block.transactions[0]['voterhash'])
+        self._record_votes(block)
             
         logger.info(f"Added block #{block.index} to the chain")
         return True
 
+    @on_writer
+    def add_blocks(self, blocks: List[Block], proofs: List[str]) -> Optional[int]:
+        """
+        Add consecutive blocks to the chain, all of them or none
+
+        Args:
+            blocks: The blocks to add, in chain order
+            proofs: The proof of work of each block
+
+        Returns:
+            Optional[int]: Position in blocks of the first rejected block,
+            None if every block was added
+        """
+        if not self.chain:
+            logger.error("Cannot add blocks to empty chain")
+            return 0
+
+        # Every block is checked before the chain is touched
+        previous_hash = self.last_block.blockhash
+        for position, (block, proof) in enumerate(zip(blocks, proofs)):
+            if previous_hash != block.previous_hash:
+                logger.warning(f"Block batch rejected at block #{block.index}: previous hash mismatch")
+                return position
+            if not self._is_valid_proof(block, proof):
+                logger.warning(f"Block batch rejected at block #{block.index}: invalid proof")
+                return position
+            previous_hash = proof
+
+        for block, proof in zip(blocks, proofs):
+            block.blockhash = proof
+            self._append(block)
+            self._record_votes(block)
+
+        logger.info(f"Added {len(blocks)} blocks to the chain")
+        return None
+
     def proof_of_work(self, block: Block) -> str:
         """
         Find a proof that satisfies our proof of work algorithm
@@ -110,25 +344,26 @@ class BlockchainInMemory(IBlockchain):
         Returns:
             str: The proof (hash) that satisfies our difficulty requirement
         """
-        block.nonce = 0
-        computed_hash = block.compute_hash()
-        
-        while not computed_hash.startswith('0' * self.DIFFICULTY):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
+        engine = ProofOfWork(block.hash_fields(), self.DIFFICULTY)
+        nonce, computed_hash = engine.parallel_search(self.MINING_WORKERS, self.MINING_CHUNK_SIZE)
+        block.seal(nonce, computed_hash)
             
         logger.debug(f"Found proof of work: {computed_hash} with nonce: {block.nonce}")
         return computed_hash
 
+    @on_writer
     def add_new_transaction(self, transaction: Dict) -> bool:
         """
-        Add a new transaction to the list of unconfirmed transactions
+        Add a new transaction to the mempool of unconfirmed transactions
         
         Args:
             transaction: The transaction to add
             
         Returns:
             bool: True if transaction was added, False otherwise
+
+        Raises:
+            MempoolFull: If the mempool reached its capacity
         """
         # Early return if transaction already exists
         voter_hash = transaction.get('voterhash')
@@ -137,32 +372,43 @@ class BlockchainInMemory(IBlockchain):
             return False
             
         # Check if voter has already voted in unconfirmed transactions
-        for unconfirmed_transaction in self.unconfirmed_transactions:
-            if unconfirmed_transaction.get('voterhash') == voter_hash:
-                logger.warning(f"Transaction rejected: voter {voter_hash} already has pending transaction")
-                return False
+        if not self.unconfirmed_transactions.add(transaction):
+            logger.warning(f"Transaction rejected: voter {voter_hash} already has pending transaction")
+            return False
                 
-        self.unconfirmed_transactions.append(transaction)
         logger.info(f"Added new transaction for voter: {voter_hash}")
         return True
 
-    def _is_valid_proof(self, block: Block, block_hash: str) -> bool:
+    @on_writer
+    def add_new_transactions(self, transactions: List[Dict]) -> List[Optional[bool]]:
+        """
+        Add a batch of transactions to the mempool in one go
+
+        Args:
+            transactions: The transactions to add, each with a voterhash
+
+        Returns:
+            List[Optional[bool]]: For every transaction, True if it was added,
+            False if its voter already has a pending transaction, None if the
+            mempool was full
+        """
+        added = self.unconfirmed_transactions.add_many(transactions)
+        logger.info(f"Added {sum(1 for result in added if result)} of {len(transactions)} new transactions")
+        return added
+
+    def _is_valid_proof(self, block: Block, block_hash: str, audit: bool = False) -> bool:
         """
         Check if block_hash is valid hash of block and satisfies difficulty criteria
         
         Args:
             block: The block to validate
             block_hash: The hash to check
+            audit: Recompute everything from the block's fields, see Block.is_valid_proof
             
         Returns:
             bool: True if the proof is valid, False otherwise
         """
-        # Check if hash meets difficulty requirement
-        if not block_hash.startswith('0' * self.DIFFICULTY):
-            return False
-            
-        # Check if hash matches block's computed hash
-        return block_hash == block.compute_hash()
+        return block.is_valid_proof(block_hash, self.DIFFICULTY, audit)
 
     def check_chain_validity(self, chain: List[Block]) -> bool:
         """
@@ -178,6 +424,12 @@ class BlockchainInMemory(IBlockchain):
             logger.warning("Cannot validate empty chain")
             return False
             
+        if self.MINING_WORKERS > 1 and len(chain) >= self.PARALLEL_VERIFY_MIN_BLOCKS:
+            try:
+                return self._check_chain_validity_parallel(chain)
+            except BrokenProcessPool:
+                logger.warning("Verification pool broke, falling back to serial validation")
+            
         previous_hash = '0'
         
         for i, block in enumerate(chain):
@@ -188,69 +440,166 @@ class BlockchainInMemory(IBlockchain):
                 previous_hash = block_hash
                 continue
                 
-            # Save original hash
-            original_hash = block.blockhash
-            
-            # Temporarily set hash to zero for validation
-            block.blockhash = '0'
-            
-            # Check if block is valid
-            if not self._is_valid_proof(block, original_hash) or previous_hash != block.previous_hash:
-                # Restore original hash before returning
-                block.blockhash = original_hash
+            # Check if block is valid, the hash does not depend on the stored blockhash
+            if not self._is_valid_proof(block, block_hash, audit=True) or previous_hash != block.previous_hash:
                 logger.warning(f"Chain validation failed at block {i}")
                 return False
                 
-            # Restore hash and update previous_hash for next iteration
-            block.blockhash = original_hash
-            previous_hash = original_hash
+            previous_hash = block_hash
             
         return True
 
+    def _check_chain_validity_parallel(self, chain: List[Block]) -> bool:
+        """
+        Check if the entire blockchain is valid, hashing blocks on the process pool
+
+        Block hashes do not depend on each other, so chunks of blocks are
+        checked by the pool workers while the cheap previous_hash linkage is
+        checked here. The failing index reported is the same as the serial
+        check's.
+        """
+        size = self.PARALLEL_VERIFY_CHUNK_SIZE
+        chunks = [(start, chain[start:start + size], self.DIFFICULTY) for start in range(1, len(chain), size)]
+        invalid = [index for index in map_on_pool(first_invalid_proof, chunks, self.MINING_WORKERS)
+                   if index is not None]
+
+        for i in range(1, len(chain)):
+            if chain[i - 1].blockhash != chain[i].previous_hash:
+                invalid.append(i)
+                break
+
+        if invalid:
+            logger.warning(f"Chain validation failed at block {min(invalid)}")
+            return False
+
+        return True
+
+    @on_writer
+    def verify_chain(self, full: bool = False) -> bool:
+        """
+        Check the validity of the node's own chain
+
+        Only the blocks past the verified height and the ones mutated since
+        they were verified are checked, unless a full audit is requested.
+
+        Args:
+            full: Rehash every block from genesis
+
+        Returns:
+            bool: True if chain is valid, False otherwise
+        """
+        if full:
+            valid = self.check_chain_validity(self.chain)
+            if valid:
+                self._verified_height = len(self.chain) - 1
+                self._dirty = set()
+            return valid
+
+        return self.first_invalid_height() is None
+
+    @on_writer
+    def first_invalid_height(self) -> Optional[int]:
+        """
+        Find the first invalid block of the node's own chain
+
+        Only the blocks past the verified height and the ones mutated since
+        they were verified are checked.
+
+        Returns:
+            Optional[int]: The height of the first invalid block, None if the
+            chain is valid
+        """
+        to_check = set(range(max(self._verified_height + 1, 1), len(self.chain)))
+        for index in self._dirty:
+            # A new blockhash also affects the linkage of the next block
+            to_check.update((index, index + 1))
+
+        for index in sorted(to_check):
+            if index == 0 or index >= len(self.chain):
+                continue
+            block = self.chain[index]
+            if not self._is_valid_proof(block, block.blockhash) or self.chain[index - 1].blockhash != block.previous_hash:
+                logger.warning(f"Chain validation failed at block {index}")
+                return index
+
+        self._verified_height = len(self.chain) - 1
+        self._dirty = set()
+        return None
+
     def mine(self) -> bool:
         """
         Mine pending transactions and add them to the blockchain
+
+        Only taking the transactions and adding the block run on the writer,
+        the proof of work runs on the calling thread so transactions and
+        blocks from peers keep being accepted meanwhile.
         
         Returns:
             bool: True if mining was successful, False otherwise
         """
-        # Early return if no transactions to mine
-        if not self.unconfirmed_transactions:
-            logger.info("No transactions to mine")
+        # Early return if no transactions to mine or another thread is mining
+        if not self._start_mining():
+            logger.info("No transactions to mine, or a block is already being mined")
             return False
-
-        self.is_mining = True
         
+        new_block = None
         try:
-            # Process each transaction one by one
-            transactions_to_process = self.unconfirmed_transactions.copy()
-            
-            for transaction in transactions_to_process:
-                # Create a new block with just this transaction
-                prev_block = self.last_block
-                new_block = Block(
-                    index=prev_block.index + 1,
-                    transactions=[transaction],
-                    timestamp=str(datetime.datetime.now()),
-                    previous_hash=prev_block.blockhash
-                )
+            # Pack pending transactions into blocks of at most MAX_BLOCK_TRANSACTIONS
+            while True:
+                new_block = self._next_block()
+                if new_block is None:
+                    return True
                 
                 # Find proof of work for this block
                 proof = self.proof_of_work(new_block)
                 
                 # Add the block to the chain
-                if self.add_block(new_block, proof):
-                    # Remove the transaction from unconfirmed list
-                    self.unconfirmed_transactions.remove(transaction)
-                    logger.info(f"Mined transaction for voter: {transaction.get('voterhash')}")
-                else:
-                    logger.warning(f"Failed to add block for transaction: {transaction}")
-            
-            return True
+                if not self.add_block(new_block, proof):
+                    logger.warning(f"Failed to add block for {len(new_block.transactions)} transactions")
+                    self._requeue(new_block.transactions)
+                    return False
+
+                logger.info(f"Mined block #{new_block.index} with {len(new_block.transactions)} transactions")
+                new_block = None
             
         except Exception as e:
             logger.error(f"Error during mining: {str(e)}")
+            if new_block is not None:
+                self._requeue(new_block.transactions)
             return False
             
         finally:
-            self.is_mining = False
+            self._writer.call(setattr, self, 'is_mining', False)
+
+    @on_writer
+    def _start_mining(self) -> bool:
+        """Claim the miner if there is something to mine, so two threads never mine at once"""
+        if self.is_mining or not self.unconfirmed_transactions:
+            return False
+        self.is_mining = True
+        return True
+
+    @on_writer
+    def _requeue(self, transactions: List[Dict]) -> None:
+        """Put the transactions of a block that was not added back, except votes a peer's block confirmed meanwhile"""
+        self.unconfirmed_transactions.requeue(transactions, exclude=self.already_voted)
+
+    @on_writer
+    def _next_block(self) -> Optional[Block]:
+        """Take the next batch of pending transactions into a block on top of the tip"""
+        if not self.unconfirmed_transactions:
+            return None
+        batch = self.unconfirmed_transactions.pop_n(self.MAX_BLOCK_TRANSACTIONS)
+        prev_block = self.last_block
+        new_block = Block(
+            index=prev_block.index + 1,
+            transactions=batch,
+            timestamp=str(datetime.datetime.now()),
+            previous_hash=prev_block.blockhash
+        )
+        new_block.merkle_root = new_block.transactions_root()
+        return new_block
+
+
+# Engine used by the views and helpers
+Blockchain = BlockchainInMemory
@@ -0,0 +1,387 @@
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import List, Set, Dict, Optional, Iterator
+
+from .models import IBlockchain
+from .blockchain import Block
+from .pow import ProofOfWork
+from .mempool import Mempool
+from . import wire
+
+logger = logging.getLogger(__name__)
+
+# record := uint32(payload size) uint32(crc32 of payload) payload
+# The payload is the block as a single block wire message
+RECORD_HEADER = struct.Struct('<II')
+# index entry := uint64(offset of the record in its segment)
+INDEX_ENTRY = struct.Struct('<Q')
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+
+class _Segment:
+    """
+    One segment file of the log and its sidecar offset index
+
+    Segments are named after the height of their first block. Both files are
+    read through mmap, the maps are redone once appends outgrow them.
+    """
+
+    def __init__(self, directory: str, base_height: int):
+        self.base_height = base_height
+        name = os.path.join(directory, f'{base_height:020d}')
+        self.log_path = name + SEGMENT_SUFFIX
+        self.index_path = name + INDEX_SUFFIX
+        self.size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        self.count = os.path.getsize(self.index_path) // INDEX_ENTRY.size if os.path.exists(self.index_path) else 0
+        self._log_map: Optional[mmap.mmap] = None
+        self._index_map: Optional[mmap.mmap] = None
+
+    def recover(self) -> None:
+        """
+        Rebuild the offset index by scanning the records
+
+        The scan stops at the first record that is cut short or fails its
+        checksum, a write torn by a crash, and the log is truncated there.
+        """
+        offsets = []
+        offset = 0
+        with open(self.log_path, 'rb') as log:
+            data = log.read()
+
+        while offset + RECORD_HEADER.size <= len(data):
+            size, crc = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + size
+            if end > len(data) or zlib.crc32(data[offset + RECORD_HEADER.size:end]) != crc:
+                break
+            offsets.append(offset)
+            offset = end
+
+        if offset != len(data):
+            logger.warning(f"Truncating torn tail of {self.log_path} at offset {offset}")
+            with open(self.log_path, 'r+b') as log:
+                log.truncate(offset)
+                os.fsync(log.fileno())
+
+        with open(self.index_path, 'wb') as index:
+            for record_offset in offsets:
+                index.write(INDEX_ENTRY.pack(record_offset))
+            os.fsync(index.fileno())
+
+        self.close()
+        self.size = offset
+        self.count = len(offsets)
+
+    def record(self, position: int) -> memoryview:
+        """Get the payload of the record at a position as a slice of the mapped log"""
+        log_map, index_map = self._maps()
+        offset, = INDEX_ENTRY.unpack_from(index_map, position * INDEX_ENTRY.size)
+        size, _ = RECORD_HEADER.unpack_from(log_map, offset)
+        start = offset + RECORD_HEADER.size
+        return memoryview(log_map)[start:start + size]
+
+    def _maps(self):
+        """Map the log and the index, again if they grew since the last map"""
+        if self._log_map is None or len(self._log_map) < self.size:
+            self.close()
+            with open(self.log_path, 'rb') as log:
+                self._log_map = mmap.mmap(log.fileno(), self.size, access=mmap.ACCESS_READ)
+            with open(self.index_path, 'rb') as index:
+                self._index_map = mmap.mmap(index.fileno(), self.count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+        return self._log_map, self._index_map
+
+    def close(self) -> None:
+        """Drop the maps, slices still held by callers keep them alive"""
+        self._log_map = None
+        self._index_map = None
+
+
+class BlockchainLog(IBlockchain):
+    """
+    Blockchain stored in append-only segment files
+
+    Every block is one length-prefixed, checksummed record appended to the
+    active segment, whose sidecar index holds the offset of each record.
+    Once a segment reaches SEGMENT_SIZE bytes a new one is started. Reads by
+    height or range go through mmap and decode straight from the mapped
+    file. On startup the last segment is scanned and a torn record left by
+    a crash is cut off.
+    """
+    # Bytes after which appends move on to a new segment
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # Flush every append to disk before it is acknowledged
+    SYNC_WRITES = True
+
+    def __init__(self, directory: str):
+        """
+        Args:
+            directory: Directory holding the segment files, created if missing
+        """
+        self.directory = directory
+        self.unconfirmed_transactions: Mempool = Mempool(self.MEMPOOL_CAPACITY)
+        self.already_voted: Set[str] = set()
+        self.nodes: Set[str] = set()
+        self.is_mining: bool = False
+
+        self._lock = threading.Lock()
+        self._segments: List[_Segment] = []
+        self._tip: Optional[Block] = None
+        self._open()
+
+    def _open(self) -> None:
+        """Load the segments, recover the last one and rebuild the in-memory state"""
+        os.makedirs(self.directory, exist_ok=True)
+        base_heights = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._segments = [_Segment(self.directory, base_height) for base_height in base_heights]
+
+        # Only the segment being appended to can end in a torn write, sealed
+        # ones are only rescanned if their index is missing
+        for segment in self._segments:
+            if segment is self._segments[-1] or not os.path.exists(segment.index_path):
+                segment.recover()
+
+        for block in self.blocks():
+            self._record_votes(block)
+            self._tip = block
+
+    def __len__(self) -> int:
+        if not self._segments:
+            return 0
+        last = self._segments[-1]
+        return last.base_height + last.count
+
+    def create_genesis_block(self) -> None:
+        """Create the first block in the chain"""
+        if len(self):
+            return
+        genesis_block = Block(0, [], 0, "0")
+        genesis_block.blockhash = genesis_block.compute_hash()
+        with self._lock:
+            self._append([genesis_block])
+
+    @property
+    def last_block(self) -> Block:
+        """Get the most recent block in the chain"""
+        if self._tip is None:
+            raise ValueError("Chain is empty")
+        return self._tip
+
+    def block_at(self, height: int) -> Optional[Block]:
+        """Get the block at a height of the chain"""
+        if not 0 <= height < len(self):
+            return None
+        position = bisect.bisect_right([segment.base_height for segment in self._segments], height) - 1
+        segment = self._segments[position]
+        return Block.from_json(wire.decode(segment.record(height - segment.base_height)))
+
+    def blocks(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Block]:
+        """Iterate over the blocks of the chain from start up to stop (exclusive)"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for segment in self._segments:
+            first = max(start, segment.base_height)
+            last = min(stop, segment.base_height + segment.count)
+            for height in range(first, last):
+                yield Block.from_json(wire.decode(segment.record(height - segment.base_height)))
+
+    def add_peer(self, peer: str) -> None:
+        """Add a new peer node to the network"""
+        if not peer:
+            logger.warning("Attempted to add empty peer")
+            return
+        self.nodes.add(peer)
+        logger.info(f"Added peer: {peer}")
+
+    def add_block(self, block: Block, proof: str) -> bool:
+        """
+        Add a block to the chain if it's valid
+
+        Args:
+            block: The block to add
+            proof: The proof of work for the block
+
+        Returns:
+            bool: True if block was added, False otherwise
+        """
+        return self.add_blocks([block], [proof]) is None
+
+    def add_blocks(self, blocks: List[Block], proofs: List[str]) -> Optional[int]:
+        """
+        Add consecutive blocks to the chain, all of them or none
+
+        Args:
+            blocks: The blocks to add, in chain order
+            proofs: The proof of work of each block
+
+        Returns:
+            Optional[int]: Position in blocks of the first rejected block,
+            None if every block was added
+        """
+        with self._lock:
+            if self._tip is None:
+                logger.error("Cannot add blocks to empty chain")
+                return 0
+
+            previous_hash = self._tip.blockhash
+            for position, (block, proof) in enumerate(zip(blocks, proofs)):
+                if previous_hash != block.previous_hash:
+                    logger.warning(f"Block #{block.index} rejected: previous hash mismatch")
+                    return position
+                if not block.is_valid_proof(proof, self.DIFFICULTY):
+                    logger.warning(f"Block #{block.index} rejected: invalid proof")
+                    return position
+                previous_hash = proof
+
+            if not blocks:
+                return None
+            for block, proof in zip(blocks, proofs):
+                block.blockhash = proof
+            self._append(blocks)
+
+        for block in blocks:
+            self._record_votes(block)
+
+        logger.info(f"Added {len(blocks)} blocks to the chain")
+        return None
+
+    def _append(self, blocks: List[Block]) -> None:
+        """
+        Write blocks at the end of the log in one write, under _lock
+
+        A batch is never split across segments, a new segment is started
+        before it if it does not fit. If the write fails, the log and its
+        index are cut back to where they were and the error is raised.
+        """
+        data = bytearray()
+        offsets = []
+        for block in blocks:
+            payload = wire.encode([block.to_dict()], wire.KIND_BLOCK)
+            offsets.append(len(data))
+            data += RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+            data += payload
+
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or (segment.size and segment.size + len(data) > self.SEGMENT_SIZE):
+            # Sealed segments are not recovered on startup, their index must be on disk
+            if segment is not None:
+                with open(segment.index_path, 'ab') as index:
+                    os.fsync(index.fileno())
+            segment = _Segment(self.directory, len(self))
+            self._segments.append(segment)
+
+        try:
+            with open(segment.log_path, 'ab') as log:
+                log.write(data)
+                if self.SYNC_WRITES:
+                    log.flush()
+                    os.fsync(log.fileno())
+
+            # The index entries follow the records, recovery rebuilds them if they are lost
+            with open(segment.index_path, 'ab') as index:
+                index.write(b''.join(INDEX_ENTRY.pack(segment.size + offset) for offset in offsets))
+        except OSError:
+            self._truncate(segment)
+            raise
+
+        segment.size += len(data)
+        segment.count += len(blocks)
+        self._tip = blocks[-1]
+
+    def _truncate(self, segment: _Segment) -> None:
+        """Cut a segment back to its last complete write, after a failed one"""
+        logger.error(f"Write to {segment.log_path} failed, truncating it back to {segment.size} bytes")
+        with open(segment.log_path, 'ab') as log:
+            log.truncate(segment.size)
+        with open(segment.index_path, 'ab') as index:
+            index.truncate(segment.count * INDEX_ENTRY.size)
+
+    def _record_votes(self, block: Block) -> None:
+        """Add every voter of the block to the already voted set"""
+        for transaction in block.transactions:
+            if 'voterhash' in transaction:
+                self.already_voted.add(transaction['voterhash'])
+                self.unconfirmed_transactions.remove(transaction['voterhash'])
+
+    def proof_of_work(self, block: Block) -> str:
+        """Find a proof that satisfies our proof of work algorithm"""
+        engine = ProofOfWork(block.hash_fields(), self.DIFFICULTY)
+        nonce, computed_hash = engine.parallel_search(self.MINING_WORKERS, self.MINING_CHUNK_SIZE)
+        block.seal(nonce, computed_hash)
+        return computed_hash
+
+    def add_new_transaction(self, transaction: Dict) -> bool:
+        """Add a new transaction to the mempool, raises MempoolFull when it is full"""
+        voter_hash = transaction.get('voterhash')
+        if not voter_hash:
+            logger.warning("Transaction rejected: missing voterhash")
+            return False
+
+        if not self.unconfirmed_transactions.add(transaction):
+            logger.warning(f"Transaction rejected: voter {voter_hash} already has pending transaction")
+            return False
+
+        logger.info(f"Added new transaction for voter: {voter_hash}")
+        return True
+
+    def add_new_transactions(self, transactions: List[Dict]) -> List[Optional[bool]]:
+        """Add a batch of transactions to the mempool, see Mempool.add_many for the results"""
+        return self.unconfirmed_transactions.add_many(transactions)
+
+    def check_chain_validity(self, chain: List[Block]) -> bool:
+        """Check if the entire blockchain is valid"""
+        if not chain:
+            logger.warning("Cannot validate empty chain")
+            return False
+
+        previous_hash = chain[0].blockhash
+        for i, block in enumerate(chain[1:], 1):
+            if not block.is_valid_proof(block.blockhash, self.DIFFICULTY, audit=True) or previous_hash != block.previous_hash:
+                logger.warning(f"Chain validation failed at block {i}")
+                return False
+            previous_hash = block.blockhash
+
+        return True
+
+    def mine(self) -> bool:
+        """Mine pending transactions and add them to the blockchain"""
+        if not self.unconfirmed_transactions or self.is_mining:
+            return False
+
+        try:
+            self.is_mining = True
+            last_block = self.last_block
+            transactions = self.unconfirmed_transactions.pop_n(len(self.unconfirmed_transactions))
+
+            new_block = Block(
+                index=last_block.index + 1,
+                transactions=transactions,
+                timestamp=str(datetime.datetime.now()),
+                previous_hash=last_block.blockhash
+            )
+            new_block.merkle_root = new_block.transactions_root()
+
+            try:
+                proof = self.proof_of_work(new_block)
+                added = self.add_block(new_block, proof)
+            except Exception:
+                self.unconfirmed_transactions.requeue(transactions, exclude=self.already_voted)
+                raise
+
+            if not added:
+                # A block from a peer may have confirmed some of the votes meanwhile
+                self.unconfirmed_transactions.requeue(transactions, exclude=self.already_voted)
+                return False
+            return True
+
+        finally:
+            self.is_mining = False
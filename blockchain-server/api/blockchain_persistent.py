@@ -1,23 +1,67 @@
 import datetime
 import json
 import logging
+import threading
 from hashlib import sha256
 from typing import List, Set, Dict, Any, Optional
-from django.db import transaction
-from .models import IBlockchain, Block as BlockModel
+from django.db import transaction, DatabaseError
+from .models import IBlockchain, Block as BlockModel, Voter
+from .pow import ProofOfWork
+from .mempool import Mempool
+from .merkle import merkle_root
+from .voters import VoterIndex
 
 logger = logging.getLogger(__name__)
 
+class _PendingWrite:
+    """Blocks waiting for a group commit, and how the commit went"""
+    __slots__ = ('blocks', 'done', 'error')
+
+    def __init__(self, blocks: List[BlockModel]):
+        self.blocks = blocks
+        self.done = False
+        self.error: Optional[Exception] = None
+
+
 class BlockchainPersistent(IBlockchain):
+    """
+    Blockchain stored in the database through the Block model
+
+    The last block is kept in memory, read from the database once when the
+    engine is created, so appending a block does not query for it. Blocks
+    are written by group commit: threads that add blocks while a commit is
+    running have theirs written together by the next one, in a single
+    transaction. The voters of every block are written to the Voter table in
+    the same transaction, already_voted answers from there.
+    """
+    # Number of voters the already_voted filter is sized for
+    VOTER_FILTER_CAPACITY = 10_000_000
+    # Share of new voters the filter lets through to the Voter table
+    VOTER_FILTER_ERROR_RATE = 0.01
+
     def __init__(self):
-        self.unconfirmed_transactions: List[Dict] = []
-        self.already_voted: Set[str] = set()
+        self.unconfirmed_transactions: Mempool = Mempool(self.MEMPOOL_CAPACITY)
+        self.already_voted: VoterIndex = VoterIndex(self.VOTER_FILTER_CAPACITY, self.VOTER_FILTER_ERROR_RATE)
         self.nodes: Set[str] = set()
         self.is_mining: bool = False
 
+        # Guards the cached tip, blocks are checked against it and queued under it
+        self._tip_lock = threading.Lock()
+        # Guards the queue of blocks waiting to be written
+        self._queue_lock = threading.Lock()
+        # Held while a group of blocks is written, so groups are committed in order
+        self._commit_lock = threading.Lock()
+        self._write_queue: List[_PendingWrite] = []
+        self._tip: Optional[BlockModel] = self._load_tip()
+        self.already_voted.load()
+
+    def _load_tip(self) -> Optional[BlockModel]:
+        """Read the last block from the database"""
+        return BlockModel.objects.order_by('-index').first()
+
     def create_genesis_block(self) -> None:
         """Create the first block in the chain"""
-        if BlockModel.objects.exists():
+        if self._tip is not None:
             return
 
         genesis_block = BlockModel(
@@ -29,14 +73,15 @@ class BlockchainPersistent(IBlockchain):
         )
         genesis_block.blockhash = self._compute_hash(genesis_block)
         genesis_block.save()
+        self._tip = genesis_block
 
     @property
     def last_block(self) -> BlockModel:
         """Get the most recent block in the chain"""
-        try:
-            return BlockModel.objects.latest('index')
-        except BlockModel.DoesNotExist:
+        tip = self._tip
+        if tip is None:
             raise ValueError("Chain is empty")
+        return tip
 
     def add_peer(self, peer: str) -> None:
         """Add a new peer node to the network"""
@@ -48,57 +93,151 @@ class BlockchainPersistent(IBlockchain):
 
     def add_block(self, block: BlockModel, proof: str) -> bool:
         """Add a block to the chain if it's valid"""
-        try:
-            previous_block = self.last_block
-        except ValueError:
-            logger.error("Cannot add block to empty chain")
-            return False
+        with self._tip_lock:
+            if self._tip is None:
+                logger.error("Cannot add block to empty chain")
+                return False
 
-        if previous_block.blockhash != block.previous_hash:
-            logger.warning("Block rejected: previous hash mismatch")
-            return False
+            if self._tip.blockhash != block.previous_hash:
+                logger.warning("Block rejected: previous hash mismatch")
+                return False
 
-        if not self._is_valid_proof(block, proof):
-            logger.warning("Block rejected: invalid proof")
-            return False
+            if not self._is_valid_proof(block, proof):
+                logger.warning("Block rejected: invalid proof")
+                return False
+
+            block.blockhash = proof
+            pending = self._queue_write([block])
 
-        block.blockhash = proof
-        block.save()
+        if not self._wait_for_write(pending):
+            return False
 
-        if block.transactions and 'voterhash' in block.transactions[0]:
-            self.already_voted.add(block.transactions[0]['voterhash'])
+        self._record_votes(block)
 
         logger.info(f"Added block #{block.index} to the chain")
         return True
 
+    def add_blocks(self, blocks: List[BlockModel], proofs: List[str]) -> Optional[int]:
+        """Add consecutive blocks to the chain, all of them or none"""
+        if not blocks:
+            return None
+
+        with self._tip_lock:
+            if self._tip is None:
+                logger.error("Cannot add blocks to empty chain")
+                return 0
+
+            previous_hash = self._tip.blockhash
+            for position, (block, proof) in enumerate(zip(blocks, proofs)):
+                if previous_hash != block.previous_hash:
+                    logger.warning(f"Block batch rejected at block #{block.index}: previous hash mismatch")
+                    return position
+                if not self._is_valid_proof(block, proof):
+                    logger.warning(f"Block batch rejected at block #{block.index}: invalid proof")
+                    return position
+                previous_hash = proof
+
+            for block, proof in zip(blocks, proofs):
+                block.blockhash = proof
+            pending = self._queue_write(blocks)
+
+        if not self._wait_for_write(pending):
+            return 0
+
+        for block in blocks:
+            self._record_votes(block)
+
+        logger.info(f"Added {len(blocks)} blocks to the chain")
+        return None
+
+    def _record_votes(self, block: BlockModel) -> None:
+        """Add every voter of the block to the already voted set"""
+        for tx in block.transactions:
+            if 'voterhash' in tx:
+                self.already_voted.add(tx['voterhash'])
+                # The vote may also be pending here when it was gossiped to several nodes
+                self.unconfirmed_transactions.remove(tx['voterhash'])
+
+    def _queue_write(self, blocks: List[BlockModel]) -> _PendingWrite:
+        """Queue checked blocks for the next group commit and make the last one the tip, under _tip_lock"""
+        pending = _PendingWrite(blocks)
+        with self._queue_lock:
+            self._write_queue.append(pending)
+        self._tip = blocks[-1]
+        return pending
+
+    def _wait_for_write(self, pending: _PendingWrite) -> bool:
+        """
+        Wait until queued blocks are written
+
+        Whichever waiting thread gets the commit lock writes every block
+        queued so far in one transaction, so blocks queued while a commit is
+        running share the next one.
+
+        Returns:
+            bool: True if the blocks were written, False if the commit failed
+        """
+        with self._commit_lock:
+            if not pending.done:
+                with self._queue_lock:
+                    group, self._write_queue = self._write_queue, []
+
+                blocks = [block for write in group for block in write.blocks]
+                try:
+                    with transaction.atomic():
+                        BlockModel.objects.bulk_create(blocks)
+                        # A voter already on the chain keeps the block of their first vote
+                        Voter.objects.bulk_create(VoterIndex.rows_for(blocks), ignore_conflicts=True)
+                except DatabaseError as e:
+                    logger.error(f"Failed to write {len(group)} block groups: {str(e)}")
+                    self._fail_writes(group, e)
+                else:
+                    for write in group:
+                        write.done = True
+
+        return pending.error is None
+
+    def _fail_writes(self, group: List[_PendingWrite], error: Exception) -> None:
+        """Fail a group whose commit failed along with every block queued on top of it"""
+        with self._tip_lock:
+            with self._queue_lock:
+                group = group + self._write_queue
+                self._write_queue = []
+            for write in group:
+                write.error = error
+                write.done = True
+            # Another writer may have extended the table, start again from what is stored
+            self._tip = self._load_tip()
+
     def proof_of_work(self, block: BlockModel) -> str:
         """Find a proof that satisfies our proof of work algorithm"""
         block.nonce = 0
-        computed_hash = self._compute_hash(block)
-
-        while not computed_hash.startswith('0' * self.DIFFICULTY):
-            block.nonce += 1
-            computed_hash = self._compute_hash(block)
+        engine = ProofOfWork(self._hash_fields(block), self.DIFFICULTY)
+        block.nonce, computed_hash = engine.parallel_search(self.MINING_WORKERS, self.MINING_CHUNK_SIZE)
 
         logger.debug(f"Found proof of work: {computed_hash} with nonce: {block.nonce}")
         return computed_hash
 
     def add_new_transaction(self, transaction: Dict) -> bool:
-        """Add a new transaction to the list of unconfirmed transactions"""
+        """Add a new transaction to the mempool, raises MempoolFull when it is full"""
         voter_hash = transaction.get('voterhash')
         if not voter_hash:
             logger.warning("Transaction rejected: missing voterhash")
             return False
 
-        for unconfirmed_transaction in self.unconfirmed_transactions:
-            if unconfirmed_transaction.get('voterhash') == voter_hash:
-                logger.warning(f"Transaction rejected: voter {voter_hash} already has pending transaction")
-                return False
+        if not self.unconfirmed_transactions.add(transaction):
+            logger.warning(f"Transaction rejected: voter {voter_hash} already has pending transaction")
+            return False
 
-        self.unconfirmed_transactions.append(transaction)
         logger.info(f"Added new transaction for voter: {voter_hash}")
         return True
 
+    def add_new_transactions(self, transactions: List[Dict]) -> List[Optional[bool]]:
+        """Add a batch of transactions to the mempool, see Mempool.add_many for the results"""
+        added = self.unconfirmed_transactions.add_many(transactions)
+        logger.info(f"Added {sum(1 for result in added if result)} of {len(transactions)} new transactions")
+        return added
+
     def check_chain_validity(self, chain: List[BlockModel]) -> bool:
         """Check if the entire blockchain is valid"""
         if not chain:
@@ -131,32 +270,49 @@ class BlockchainPersistent(IBlockchain):
         try:
             self.is_mining = True
             last_block = self.last_block
+            transactions = self.unconfirmed_transactions.pop_n(len(self.unconfirmed_transactions))
 
             new_block = BlockModel(
                 index=last_block.index + 1,
-                transactions=self.unconfirmed_transactions,
+                transactions=transactions,
                 timestamp=str(datetime.datetime.now()),
-                previous_hash=last_block.blockhash
+                previous_hash=last_block.blockhash,
+                merkle_root=merkle_root(transactions)
             )
 
-            proof = self.proof_of_work(new_block)
-            self.add_block(new_block, proof)
-            self.unconfirmed_transactions = []
+            try:
+                proof = self.proof_of_work(new_block)
+                added = self.add_block(new_block, proof)
+            except Exception:
+                self.unconfirmed_transactions.requeue(transactions, exclude=self.already_voted)
+                raise
+
+            if not added:
+                # A block from a peer may have confirmed some of the votes meanwhile
+                self.unconfirmed_transactions.requeue(transactions, exclude=self.already_voted)
+                return False
             return True
 
         finally:
             self.is_mining = False
 
-    def _compute_hash(self, block: BlockModel) -> str:
-        """Compute SHA-256 hash of the block"""
-        block_dict = {
+    def _hash_fields(self, block: BlockModel) -> Dict[str, Any]:
+        """Get the fields of the block that are covered by its hash, the header alone if it has a merkle root"""
+        fields = {
             'index': block.index,
-            'transactions': block.transactions,
             'timestamp': block.timestamp,
             'previous_hash': block.previous_hash,
             'nonce': block.nonce
         }
-        block_string = json.dumps(block_dict, sort_keys=True)
+        if block.merkle_root is None:
+            fields['transactions'] = block.transactions
+        else:
+            fields['merkle_root'] = block.merkle_root
+        return fields
+
+    def _compute_hash(self, block: BlockModel) -> str:
+        """Compute SHA-256 hash of the block"""
+        block_string = json.dumps(self._hash_fields(block), sort_keys=True)
         return sha256(block_string.encode()).hexdigest()
 
     def _is_valid_proof(self, block: BlockModel, block_hash: str) -> bool:
@@ -164,4 +320,7 @@ class BlockchainPersistent(IBlockchain):
         if not block_hash.startswith('0' * self.DIFFICULTY):
             return False
 
+        if block.merkle_root is not None and block.merkle_root != merkle_root(block.transactions):
+            return False
+
         return block_hash == self._compute_hash(block)
\ No newline at end of file
@@ -0,0 +1,140 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from .models import IBlockchain
+from .helpers import announce_new_blocks, announce_new_transactions, consensus
+
+logger = logging.getLogger(__name__)
+
+
+class SeenCache:
+    """
+    Bounded set of recently seen hashes
+
+    Once the capacity is reached, the hash seen the longest time ago is
+    forgotten first.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._hashes: 'OrderedDict[str, None]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._hashes
+
+    def add(self, key: str) -> bool:
+        """
+        Remember a hash
+
+        Returns:
+            bool: True if the hash was not seen before
+        """
+        with self._lock:
+            if key in self._hashes:
+                self._hashes.move_to_end(key)
+                return False
+            self._hashes[key] = None
+            if len(self._hashes) > self.capacity:
+                self._hashes.popitem(last=False)
+            return True
+
+    def discard(self, key: str) -> None:
+        """Forget a hash"""
+        with self._lock:
+            self._hashes.pop(key, None)
+
+
+class Gossip:
+    """
+    Epidemic propagation of blocks and transactions
+
+    New blocks and transactions are pushed to a few random peers, which push
+    them on in turn, so every node only sends to GOSSIP_FANOUT peers while
+    the whole network hears of them after O(log N) hops. Hashes already seen
+    are neither processed nor forwarded again. A node that receives a block
+    it cannot attach pulls the missing blocks from its peers instead.
+
+    Forwarding and pulling run on a background thread, so the node that
+    pushed to us gets its answer without waiting for the next hop. Votes
+    waiting for that thread are collected into one batch, so a burst of
+    votes queues a single task rather than one per vote.
+    """
+    # Number of block and transaction hashes remembered
+    SEEN_CACHE_SIZE = 10000
+    # Votes waiting to be forwarded, the ones past it are not forwarded
+    MAX_PENDING_TRANSACTIONS = 10000
+
+    def __init__(self, seen_capacity: int = SEEN_CACHE_SIZE):
+        self.blocks_seen = SeenCache(seen_capacity)
+        self.transactions_seen = SeenCache(seen_capacity)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gossip')
+        self._pull_pending = threading.Event()
+        self._pending_lock = threading.Lock()
+        self._pending_transactions: List[Dict] = []
+        self._flush_queued = False
+
+    def forward_blocks(self, blockchain: IBlockchain, blocks: List) -> None:
+        """Push blocks just added to the chain on to random peers"""
+        for block in blocks:
+            self.blocks_seen.add(block.blockhash)
+        self._executor.submit(self._run, announce_new_blocks, blockchain, blocks)
+
+    def forward_transaction(self, blockchain: IBlockchain, transaction: Dict) -> None:
+        """Push a transaction just added to the mempool on to random peers, once"""
+        self.forward_transactions(blockchain, [transaction])
+
+    def forward_transactions(self, blockchain: IBlockchain, transactions: List[Dict]) -> None:
+        """Push transactions just added to the mempool on to random peers, each once"""
+        new = [transaction for transaction in transactions if self.transactions_seen.add(transaction['voterhash'])]
+        if not new:
+            return
+
+        with self._pending_lock:
+            room = max(0, self.MAX_PENDING_TRANSACTIONS - len(self._pending_transactions))
+            self._pending_transactions.extend(new[:room])
+            queue_flush = not self._flush_queued
+            self._flush_queued = True
+
+        if len(new) > room:
+            logger.warning(f"Gossip queue is full, not forwarding {len(new) - room} transactions")
+            # A later copy of a dropped vote gets another chance to be forwarded
+            for transaction in new[room:]:
+                self.transactions_seen.discard(transaction['voterhash'])
+
+        if queue_flush:
+            self._executor.submit(self._flush_transactions, blockchain)
+
+    def _flush_transactions(self, blockchain: IBlockchain) -> None:
+        """Forward every vote collected so far in one batch, on the gossip thread"""
+        with self._pending_lock:
+            transactions, self._pending_transactions = self._pending_transactions, []
+            self._flush_queued = False
+        if transactions:
+            self._run(announce_new_transactions, blockchain, transactions)
+
+    def request_pull(self, blockchain: IBlockchain) -> None:
+        """Pull the blocks we are missing from the peers, at most one pull queued at a time"""
+        if self._pull_pending.is_set():
+            return
+        self._pull_pending.set()
+        self._executor.submit(self._pull, blockchain)
+
+    def _pull(self, blockchain: IBlockchain) -> None:
+        """Run consensus with the peers on the gossip thread"""
+        self._pull_pending.clear()
+        if self._run(consensus, blockchain):
+            logger.info(f"Pulled missing blocks up to #{blockchain.state.last_block.index}")
+
+    def _run(self, fn, *args):
+        """Run a gossip task, logging instead of raising its errors"""
+        try:
+            return fn(*args)
+        except Exception as e:
+            logger.error(f"Gossip task {fn.__name__} failed: {str(e)}")
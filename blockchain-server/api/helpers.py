@@ -1,25 +1,87 @@
 import json
 import logging
-from typing import Tuple, Optional, List
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from typing import Tuple, Optional, List, Iterator, Iterable, Callable, Any
 import requests
 from requests.exceptions import RequestException
-from .blockchain import Blockchain, Block
+from .blockchain import Blockchain, Block, ChainState
+from .peers import PeerClient, get_client
+from . import wire
 
 logger = logging.getLogger(__name__)
 
+# Size in characters of the pieces a streamed chain is written in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Seconds a round of calls to every peer may take before the slow peers are given up on
+PEER_DEADLINE = 20.0
+
+# Largest number of peers called at the same time
+PEER_WORKERS = 16
+
+# Largest number of blocks announced to a peer in one request
+ANNOUNCE_BATCH_SIZE = 500
+
+# Number of random peers new blocks and transactions are pushed to, the rest
+# of the network hears of them from those peers
+GOSSIP_FANOUT = 4
+
+def call_peers(nodes: Iterable[str], fn: Callable[[str], Any],
+               deadline: float = PEER_DEADLINE) -> Iterator[Tuple[str, Any]]:
+    """
+    Calls fn for every node concurrently and yields the results as they arrive
+    Nodes whose call fails, or is still running once the deadline passes, are skipped
+    Returns: Iterator of (node, result) pairs
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(len(nodes), PEER_WORKERS))
+    futures = {executor.submit(fn, node): node for node in nodes}
+
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            node = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # A peer answering with garbage only loses its own say in the round
+                logger.error(f"Error calling node {node}: {str(e)}")
+                continue
+            yield node, result
+    except TimeoutError:
+        slow = [node for future, node in futures.items() if not future.done()]
+        logger.warning(f"Gave up on nodes after {deadline}s: {', '.join(slow)}")
+    finally:
+        # Calls still running finish in the background, bounded by their timeouts
+        executor.shutdown(wait=False, cancel_futures=True)
+
 def fetch_chain_from_node(node: str) -> Tuple[Optional[dict], Optional[str]]:
     """
     Fetches blockchain data from a node
     Returns: Tuple of (response_data, error_message)
     """
+    # Nodes that do not speak the wire format answer in JSON
+    headers = {'Accept': f'{wire.MEDIA_TYPE}, application/json;q=0.5'}
+
     try:
-        response = requests.get(f'{node}/chain')
+        response = get_client(node).get('/chain/', headers=headers)
         response.raise_for_status()
-        return response.json(), None
-    except RequestException as e:
+        return parse_chain_response(response), None
+    except (RequestException, ValueError) as e:
         logger.error(f"Error fetching chain from node {node}: {str(e)}")
         return None, f"Failed to fetch chain from node: {str(e)}"
 
+def parse_chain_response(response: requests.Response) -> dict:
+    """
+    Decodes a chain response from a node, in the wire format or in JSON
+    """
+    if response.headers.get('Content-Type', '').startswith(wire.MEDIA_TYPE):
+        return wire.decode(response.content)
+    return response.json()
+
 def format_chain_from_json(chain_json: List[dict]) -> Blockchain:
     """
     Creates a formatted blockchain from JSON data
@@ -29,6 +91,160 @@ def format_chain_from_json(chain_json: List[dict]) -> Blockchain:
     formatted_chain.chain = [Block.from_json(block) for block in chain_json]
     return formatted_chain
 
+def fetch_tip_from_node(node: str) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Fetches the length and last block hash of a node's chain
+    Returns: Tuple of (tip_data, error_message)
+    Raises: ValueError if the node answers with a malformed tip
+    """
+    try:
+        response = get_client(node).get('/tip/')
+        response.raise_for_status()
+        tip = response.json()
+    except (RequestException, ValueError) as e:
+        logger.error(f"Error fetching tip from node {node}: {str(e)}")
+        return None, f"Failed to fetch tip from node: {str(e)}"
+
+    if (not isinstance(tip, dict) or type(tip.get('length')) is not int or tip['length'] < 1
+            or not isinstance(tip.get('blockhash'), str)):
+        raise ValueError(f"Node {node} sent a malformed tip")
+    return tip, None
+
+def fetch_block_hash_from_node(node: str, height: int) -> str:
+    """
+    Fetches the hash of the block at a height of a node's chain
+    """
+    response = get_client(node).get('/headers/', params={'since_height': height, 'limit': 1})
+    response.raise_for_status()
+    headers = response.json()['headers']
+    if not headers:
+        raise ValueError(f"Node has no block at height {height}")
+    return headers[0]['blockhash']
+
+def fetch_blocks_from_node(node: str, since_height: int, length: int) -> List[Block]:
+    """
+    Fetches the blocks of a node's chain from since_height up to length, range by range
+    Every range is followed by the one at its next_cursor, until the node has no more
+    """
+    headers = {'Accept': f'{wire.MEDIA_TYPE}, application/json;q=0.5'}
+    blocks = []
+    cursor = since_height
+
+    while cursor is not None and cursor < length:
+        response = get_client(node).get(
+            '/chain/',
+            params={'since_height': cursor},
+            headers=headers
+        )
+        response.raise_for_status()
+        chain_data = parse_chain_response(response)
+        if not chain_data['chain']:
+            break
+        blocks.extend(Block.from_json(block) for block in chain_data['chain'])
+        # Nodes that send no cursor are asked for the range after the blocks they sent
+        next_cursor = chain_data.get('next_cursor', since_height + len(blocks))
+        if next_cursor is not None and next_cursor <= cursor:
+            raise ValueError(f"Node {node} sent a cursor that does not move forward")
+        cursor = next_cursor
+
+    return blocks[:length - since_height]
+
+def find_common_ancestor(state: ChainState, node: str, highest: int) -> int:
+    """
+    Finds the height of the last block a state of our chain shares with a node's chain
+    Only heights up to highest are considered, genesis blocks are assumed equal
+    """
+    # Fast path: the node only extends our chain
+    if highest <= 0 or fetch_block_hash_from_node(node, highest) == state.chain[highest].blockhash:
+        return max(highest, 0)
+
+    # Blocks are chained by hash, so once the chains differ they differ up to the tip
+    matching, differing = 0, highest
+    while differing - matching > 1:
+        middle = (matching + differing) // 2
+        if fetch_block_hash_from_node(node, middle) == state.chain[middle].blockhash:
+            matching = middle
+        else:
+            differing = middle
+    return matching
+
+def trusted_height(blockchain: Blockchain, state: ChainState) -> int:
+    """
+    Gets the height of the last block of a state of our chain that can be shared with peers
+    """
+    first_invalid = blockchain.first_invalid_height()
+    if first_invalid is None:
+        return state.length - 1
+    return min(first_invalid, state.length) - 1
+
+def fetch_missing_blocks(blockchain: Blockchain, state: ChainState, node: str, min_length: int,
+                         trusted: int) -> Optional[Tuple[int, List[Block], int]]:
+    """
+    Headers-first download of the part of a node's chain we do not have
+
+    The node's tip is fetched first and nothing more happens unless its chain
+    is at least min_length long. The common ancestor is then found by binary
+    search over block hashes and only the blocks after it are downloaded and
+    validated. Only our blocks up to the trusted height are compared, the
+    caller works out that height once for every node it asks. Every block of
+    ours is read from state, so blocks the writer replaces meanwhile cannot
+    mix into the comparison.
+
+    Returns: Tuple of (ancestor_height, missing_blocks, chain_length), None if
+    the node has nothing better to offer
+    """
+    tip, error = fetch_tip_from_node(node)
+    if error:
+        # Nodes without the /tip/ endpoint still serve their whole chain
+        return fetch_full_chain(blockchain, node, min_length)
+
+    length = tip['length']
+    if length < min_length:
+        return None
+
+    # Nothing to fetch from a node with the same valid chain
+    if length == trusted + 1 and tip['blockhash'] == state.chain[trusted].blockhash:
+        return None
+
+    ancestor = find_common_ancestor(state, node, min(trusted, length - 1))
+    blocks = fetch_blocks_from_node(node, ancestor + 1, length)
+
+    if len(blocks) != length - ancestor - 1:
+        logger.warning(f"Node {node} returned {len(blocks)} blocks, expected {length - ancestor - 1}")
+        return None
+
+    if any(block.index != ancestor + 1 + i for i, block in enumerate(blocks)):
+        logger.warning(f"Node {node} returned blocks out of order")
+        return None
+
+    # The ancestor stands in for the genesis block, only the new blocks are checked
+    if blocks and not blockchain.check_chain_validity([state.chain[ancestor]] + blocks):
+        logger.warning(f"Node {node} returned invalid blocks")
+        return None
+
+    return ancestor, blocks, length
+
+def fetch_full_chain(blockchain: Blockchain, node: str,
+                     min_length: int) -> Optional[Tuple[int, List[Block], int]]:
+    """
+    Downloads a node's whole chain, for nodes that cannot be synced headers-first
+    Returns: Same as fetch_missing_blocks, with the genesis block as ancestor
+    """
+    response_data, error = fetch_chain_from_node(node)
+    if error:
+        logger.warning(f"Skipping node {node}: {error}")
+        return None
+
+    chain = format_chain_from_json(response_data['chain']).chain
+    if len(chain) < min_length:
+        return None
+
+    if not chain or not blockchain.check_chain_validity(chain):
+        logger.warning(f"Node {node} returned an invalid chain")
+        return None
+
+    return 0, chain[1:], len(chain)
+
 def consensus(blockchain: Blockchain) -> bool:
     """
     Implements the consensus algorithm to ensure all nodes have the same chain
@@ -37,53 +253,177 @@ def consensus(blockchain: Blockchain) -> bool:
         logger.info("No nodes available for consensus")
         return False
 
-    current_length = len(blockchain.chain)
-    longest_chain = None
+    state = blockchain.state
+    current_length = state.length
+    trusted = trusted_height(blockchain, state)
+    best = None
 
-    for node in blockchain.nodes:
-        chain_data, error = fetch_chain_from_node(node)
-        if error:
-            logger.warning(f"Skipping node {node}: {error}")
-            continue
+    def fetch(node):
+        return fetch_missing_blocks(blockchain, state, node, current_length + 1, trusted)
 
-        try:
-            formatted_chain = format_chain_from_json(chain_data['chain'])
-            chain_length = chain_data['length']
-
-            if chain_length > current_length and blockchain.check_chain_validity(formatted_chain.chain):
-                current_length = chain_length
-                longest_chain = formatted_chain.chain
-                logger.info(f"Found longer valid chain from node {node}")
-        except Exception as e:
-            logger.error(f"Error processing chain from node {node}: {str(e)}")
-            continue
+    for node, result in call_peers(blockchain.nodes, fetch):
+        if result and (best is None or result[2] > best[2]):
+            best = result
+            logger.info(f"Found longer valid chain from node {node}")
 
-    if longest_chain:
-        blockchain.chain = longest_chain
+    # The blocks are dropped if our chain changed while the peers were asked
+    if best and blockchain.replace_suffix(best[0], best[1], current_length):
         logger.info("Consensus achieved, chain updated")
         return True
 
     logger.info("No longer valid chain found")
     return False
 
+def post_to_node(client: PeerClient, path: str, wire_data: bytes, json_data: Any) -> requests.Response:
+    """
+    Posts blocks to a node in the wire format
+    Falls back to JSON for nodes that do not speak the wire format
+    """
+    response = client.post(path, data=wire_data, headers={'Content-Type': wire.MEDIA_TYPE})
+    if response.status_code == 415:
+        response = client.post(path, data=json.dumps(json_data), headers={'Content-Type': 'application/json'})
+    return response
+
+def send_blocks_to_node(node: str, block_dicts: List[dict]) -> None:
+    """
+    Sends blocks to a node, ANNOUNCE_BATCH_SIZE blocks per request to /add_blocks/
+    Nodes without /add_blocks/ get the blocks one by one on /add_block/
+    """
+    client = get_client(node)
+
+    for start in range(0, len(block_dicts), ANNOUNCE_BATCH_SIZE):
+        batch = block_dicts[start:start + ANNOUNCE_BATCH_SIZE]
+        response = post_to_node(client, '/add_blocks/', wire.encode(batch, wire.KIND_CHAIN), {'chain': batch})
+
+        if response.status_code == 404:
+            for block in batch:
+                response = post_to_node(client, '/add_block/', wire.encode([block], wire.KIND_BLOCK), block)
+                response.raise_for_status()
+            continue
+
+        response.raise_for_status()
+
+def select_peers(nodes: Iterable[str], fanout: int = GOSSIP_FANOUT, exclude: Iterable[str] = ()) -> List[str]:
+    """
+    Picks up to fanout random nodes to gossip to
+    """
+    exclude = set(exclude)
+    candidates = [node for node in nodes if node not in exclude]
+    if len(candidates) <= fanout:
+        return candidates
+    return random.sample(candidates, fanout)
+
+def announce_new_blocks(blockchain: Blockchain, blocks: List[Block],
+                        nodes: Optional[Iterable[str]] = None) -> None:
+    """
+    Announces new blocks to the network
+    Every node is sent the blocks in one batch, all nodes at the same time. Unless
+    nodes are given, GOSSIP_FANOUT random peers are picked and they pass the blocks on.
+    """
+    if not blocks:
+        return
+
+    if nodes is None:
+        nodes = select_peers(blockchain.nodes)
+
+    block_dicts = [block.to_dict() for block in blocks]
+
+    def send(node):
+        send_blocks_to_node(node, block_dicts)
+        return True
+
+    for peer, _ in call_peers(nodes, send):
+        logger.info(f"Successfully announced {len(blocks)} blocks to {peer}")
+
 def announce_new_block(blockchain: Blockchain, block: Block) -> None:
     """
-    Announces a newly mined block to all nodes in the network
+    Announces a newly mined block to the network
     """
-    headers = {'Content-Type': 'application/json'}
-    block_data = json.dumps(block.__dict__)
+    announce_new_blocks(blockchain, [block])
 
-    for peer in blockchain.nodes:
-        try:
-            response = requests.post(
-                f'{peer}/add_block/',
-                data=block_data,
-                headers=headers
-            )
-            response.raise_for_status()
-            logger.info(f"Successfully announced block to {peer}")
-        except RequestException as e:
-            logger.error(f"Failed to announce block to {peer}: {str(e)}")
+def announce_new_transactions(blockchain: Blockchain, transactions: List[dict],
+                              nodes: Optional[Iterable[str]] = None) -> None:
+    """
+    Announces new transactions to GOSSIP_FANOUT random peers, or to the given nodes
+    Every node is sent the transactions in one request to /new_transactions/,
+    nodes without it get them one by one on /new_transaction/
+    """
+    if not transactions:
+        return
+
+    if nodes is None:
+        nodes = select_peers(blockchain.nodes)
+
+    data = [{key: transaction[key] for key in ('candidate', 'voterhash')} for transaction in transactions]
+
+    def send(node):
+        client = get_client(node)
+        response = client.post('/new_transactions/', json=data)
+        if response.status_code == 404:
+            for transaction in data:
+                # Nodes that already have the vote answer with a conflict or a rejection
+                response = client.post('/new_transaction/', json=transaction)
+                if response.status_code >= 500:
+                    response.raise_for_status()
+            return
+        response.raise_for_status()
+
+    for peer, _ in call_peers(nodes, send):
+        logger.debug(f"Announced {len(transactions)} transactions to {peer}")
+
+def announce_new_transaction(blockchain: Blockchain, transaction: dict,
+                             nodes: Optional[Iterable[str]] = None) -> None:
+    """
+    Announces a new transaction to GOSSIP_FANOUT random peers, or to the given nodes
+    """
+    announce_new_transactions(blockchain, [transaction], nodes)
+
+def mine_and_announce(blockchain: Blockchain) -> bool:
+    """
+    Mines the pending transactions and announces the new blocks to the network
+    Returns: True if any transactions were mined
+    """
+    prev_length = blockchain.state.length
+
+    if not blockchain.mine():
+        return False
+
+    mined = blockchain.state
+
+    consensus(blockchain)
+
+    # Only announce our blocks if consensus did not replace our chain
+    if mined.length == blockchain.state.length:
+        announce_new_blocks(blockchain, mined.chain[prev_length:])
+
+    return True
+
+def stream_chain_json(blockchain: Blockchain) -> Iterator[str]:
+    """
+    Writes the chain as the JSON document returned by /chain, block by block
+    Only one chunk of the output is held in memory at a time
+    """
+    # Take one state of the chain, later blocks are left out
+    state = blockchain.state
+    chain = state.chain
+    length = state.length
+    peers = list(blockchain.nodes)
+
+    buffer = [f'{{"length": {length}, "chain": [']
+    buffered = len(buffer[0])
+
+    for i in range(length):
+        block_json = json.dumps(chain[i].to_dict())
+        buffer.append(block_json if i == 0 else ', ' + block_json)
+        buffered += len(block_json) + 2
+
+        if buffered >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+
+    buffer.append(f'], "peers": {json.dumps(peers)}}}')
+    yield ''.join(buffer)
 
 def create_chain_from_dump(chain_dump: List[dict]) -> Blockchain:
     """
@@ -94,25 +434,28 @@ def create_chain_from_dump(chain_dump: List[dict]) -> Blockchain:
 
     generated_blockchain = Blockchain()
     generated_blockchain.create_genesis_block()
+    chain = [generated_blockchain.last_block]
 
     # Skip genesis block (index 0)
     for block_data in chain_dump[1:]:
         try:
-            block = Block(
+            chain.append(Block(
                 block_data["index"],
                 block_data["transactions"],
                 block_data["timestamp"],
                 block_data["previous_hash"],
-                block_data["nonce"]
-            )
-            proof = block_data['blockhash']
-            
-            if not generated_blockchain.add_block(block, proof):
-                raise ValueError("Invalid block detected")
-                
+                block_data["nonce"],
+                block_data["blockhash"],
+                merkle_root=block_data.get("merkle_root")
+            ))
         except KeyError as e:
             raise ValueError(f"Missing required field in block data: {str(e)}")
 
+    # Validate the whole dump at once so long chains are checked on the process pool
+    if not generated_blockchain.check_chain_validity(chain):
+        raise ValueError("Invalid block detected")
+
+    generated_blockchain.replace_chain(chain, verified=True)
     return generated_blockchain
 
 def sync_with_nodes(blockchain: Blockchain) -> Tuple[bool, str]:
@@ -122,29 +465,20 @@ def sync_with_nodes(blockchain: Blockchain) -> Tuple[bool, str]:
     if not blockchain.nodes:
         return False, 'Current node is not connected with any other nodes'
 
-    current_length = len(blockchain.chain)
-    longest_chain = None
+    state = blockchain.state
+    current_length = state.length
+    trusted = trusted_height(blockchain, state)
+    best = None
 
-    for node in blockchain.nodes:
-        chain_data, error = fetch_chain_from_node(node)
-        if error:
-            logger.warning(f"Skipping node {node} during sync: {error}")
-            continue
+    def fetch(node):
+        return fetch_missing_blocks(blockchain, state, node, current_length, trusted)
 
-        try:
-            formatted_chain = format_chain_from_json(chain_data['chain'])
-            chain_length = chain_data['length']
-
-            if chain_length >= current_length and blockchain.check_chain_validity(formatted_chain.chain):
-                current_length = chain_length
-                longest_chain = formatted_chain.chain
-                logger.info(f"Found valid chain from node {node}")
-        except Exception as e:
-            logger.error(f"Error processing chain during sync from node {node}: {str(e)}")
-            continue
+    for node, result in call_peers(blockchain.nodes, fetch):
+        if result and (best is None or result[2] > best[2]):
+            best = result
+            logger.info(f"Found valid chain from node {node}")
 
-    if longest_chain:
-        blockchain.chain = longest_chain
+    if best and blockchain.replace_suffix(best[0], best[1], current_length):
         return True, 'Synchronized with honest nodes'
 
-    return False, 'No valid chains found from connected nodes'
\ No newline at end of file
+    return False, 'No valid chains found from connected nodes'
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+from typing import Container, Dict, Iterator, List, Optional
+
+
+class MempoolFull(Exception):
+    """Raised when a transaction is added to a mempool that reached its capacity"""
+    pass
+
+
+class Mempool:
+    """
+    Bounded pool of unconfirmed transactions
+
+    Transactions are kept in arrival order in a dict keyed by voterhash, so
+    inserting, looking up and removing a transaction are O(1) and the miner
+    takes its batches from the head of the pool.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._transactions: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._transactions)
+
+    def __contains__(self, voter_hash: str) -> bool:
+        return voter_hash in self._transactions
+
+    def __iter__(self) -> Iterator[Dict]:
+        with self._lock:
+            return iter(list(self._transactions.values()))
+
+    @property
+    def is_full(self) -> bool:
+        """Check if the pool reached its capacity"""
+        return len(self._transactions) >= self.capacity
+
+    def add(self, transaction: Dict) -> bool:
+        """
+        Add a transaction at the tail of the pool
+
+        Args:
+            transaction: The transaction to add, keyed by its voterhash
+
+        Returns:
+            bool: True if the transaction was added, False if its voter
+            already has a pending transaction
+
+        Raises:
+            MempoolFull: If the pool reached its capacity
+        """
+        voter_hash = transaction['voterhash']
+        with self._lock:
+            if voter_hash in self._transactions:
+                return False
+            if len(self._transactions) >= self.capacity:
+                raise MempoolFull(f"Mempool reached its capacity of {self.capacity} transactions")
+            self._transactions[voter_hash] = transaction
+            return True
+
+    def add_many(self, transactions: List[Dict]) -> List[Optional[bool]]:
+        """
+        Add transactions at the tail of the pool, in order, under one lock
+
+        Args:
+            transactions: The transactions to add, keyed by their voterhash
+
+        Returns:
+            List[Optional[bool]]: For every transaction, True if it was added,
+            False if its voter already has a pending transaction, None if the
+            pool had reached its capacity
+        """
+        added = []
+        with self._lock:
+            for transaction in transactions:
+                voter_hash = transaction['voterhash']
+                if voter_hash in self._transactions:
+                    added.append(False)
+                elif len(self._transactions) >= self.capacity:
+                    added.append(None)
+                else:
+                    self._transactions[voter_hash] = transaction
+                    added.append(True)
+        return added
+
+    def get(self, voter_hash: str) -> Optional[Dict]:
+        """Get the pending transaction of a voter"""
+        return self._transactions.get(voter_hash)
+
+    def remove(self, voter_hash: str) -> Optional[Dict]:
+        """Remove the pending transaction of a voter and return it"""
+        with self._lock:
+            return self._transactions.pop(voter_hash, None)
+
+    def pop_n(self, count: int) -> List[Dict]:
+        """
+        Remove up to count transactions from the head of the pool
+
+        Args:
+            count: Maximum number of transactions to take
+
+        Returns:
+            List[Dict]: The transactions taken, oldest first
+        """
+        with self._lock:
+            count = min(count, len(self._transactions))
+            return [self._transactions.popitem(last=False)[1] for _ in range(count)]
+
+    def requeue(self, transactions: List[Dict], exclude: Container[str] = ()) -> None:
+        """
+        Put transactions taken by pop_n back at the head of the pool
+
+        The capacity is not enforced since the transactions were already
+        accounted for when they were first added.
+
+        Args:
+            transactions: The transactions taken
+            exclude: Voters left out, the ones whose vote reached the chain
+                in another block while these were taken
+        """
+        with self._lock:
+            for transaction in reversed(transactions):
+                voter_hash = transaction['voterhash']
+                if voter_hash in exclude:
+                    continue
+                self._transactions[voter_hash] = transaction
+                self._transactions.move_to_end(voter_hash, last=False)
+
+    def clear(self) -> None:
+        """Remove every transaction from the pool"""
+        with self._lock:
+            self._transactions.clear()
@@ -0,0 +1,96 @@
+import json
+from hashlib import sha256
+from typing import List, Dict
+
+# Domain separation between leaves and inner nodes, so a pair of
+# transactions can never be passed off as a single one
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def hash_leaf(transaction: Dict) -> bytes:
+    """Hash a transaction into a merkle tree leaf"""
+    return sha256(LEAF_PREFIX + json.dumps(transaction, sort_keys=True).encode()).digest()
+
+
+def hash_node(left: bytes, right: bytes) -> bytes:
+    """Hash two sibling nodes into their parent"""
+    return sha256(NODE_PREFIX + left + right).digest()
+
+
+def _next_level(level: List[bytes]) -> List[bytes]:
+    """Pair up the nodes of a level, an unpaired last node moves up unchanged"""
+    parents = [hash_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(transactions: List[Dict]) -> str:
+    """
+    Compute the merkle root of a list of transactions
+
+    Args:
+        transactions: The transactions of a block, in block order
+
+    Returns:
+        str: The hex encoded root, the hash of nothing for an empty list
+    """
+    if not transactions:
+        return sha256(b'').hexdigest()
+
+    level = [hash_leaf(transaction) for transaction in transactions]
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0].hex()
+
+
+def merkle_path(transactions: List[Dict], position: int) -> List[Dict[str, str]]:
+    """
+    Compute the path from a transaction up to the merkle root
+
+    Args:
+        transactions: The transactions of a block, in block order
+        position: Position of the transaction in the block
+
+    Returns:
+        List[Dict[str, str]]: The sibling hashes from the leaf up, each with
+        the side ('left' or 'right') it is combined on
+    """
+    if not 0 <= position < len(transactions):
+        raise IndexError(f"No transaction at position {position}")
+
+    path = []
+    level = [hash_leaf(transaction) for transaction in transactions]
+    while len(level) > 1:
+        sibling = position ^ 1
+        if sibling < len(level):
+            path.append({
+                'hash': level[sibling].hex(),
+                'position': 'left' if sibling < position else 'right'
+            })
+        level = _next_level(level)
+        position //= 2
+    return path
+
+
+def verify_merkle_path(transaction: Dict, path: List[Dict[str, str]], root: str) -> bool:
+    """
+    Check that a transaction is included under a merkle root
+
+    Args:
+        transaction: The transaction to check
+        path: The path returned by merkle_path
+        root: The hex encoded merkle root of the block
+
+    Returns:
+        bool: True if the path leads from the transaction to the root
+    """
+    node = hash_leaf(transaction)
+    for step in path:
+        sibling = bytes.fromhex(step['hash'])
+        if step['position'] == 'left':
+            node = hash_node(sibling, node)
+        else:
+            node = hash_node(node, sibling)
+    return node.hex() == root
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.3 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Block',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField(unique=True)),
+                ('transactions', models.JSONField()),
+                ('timestamp', models.CharField(max_length=50)),
+                ('previous_hash', models.CharField(max_length=64)),
+                ('nonce', models.IntegerField(default=0)),
+                ('blockhash', models.CharField(default='0', max_length=64)),
+                ('merkle_root', models.CharField(blank=True, max_length=64, null=True)),
+            ],
+            options={
+                'ordering': ['index'],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.3 on 2026-10-18 06:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Voter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('voterhash', models.CharField(max_length=255, unique=True)),
+                ('block_index', models.IntegerField(db_index=True)),
+            ],
+        ),
+    ]
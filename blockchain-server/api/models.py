@@ -1,29 +1,42 @@
+from django.conf import settings
 from django.db import models
-from typing import List, Dict, Any, Set
+from typing import List, Dict, Any, Set, Optional
 from abc import ABC, abstractmethod
 import json
 
 
 class Block(models.Model):
-    index = models.IntegerField(db_index=True)  # Added db_index for faster querying
+    index = models.IntegerField(unique=True)  # Unique so that concurrent writers cannot fork the table
     transactions = models.JSONField()
     timestamp = models.CharField(max_length=50)  # Store as string for compatibility
     previous_hash = models.CharField(max_length=64)
     nonce = models.IntegerField(default=0)
     blockhash = models.CharField(max_length=64, default='0')
+    merkle_root = models.CharField(max_length=64, null=True, blank=True)  # None for blocks hashed over their transactions
 
     class Meta:
         ordering = ['index']
-        indexes = [
-            models.Index(fields=['index']),
-        ]
 
     def __str__(self):
         return f'Block {self.index}'
 
 
+class Voter(models.Model):
+    voterhash = models.CharField(max_length=255, unique=True)
+    block_index = models.IntegerField(db_index=True)  # Height of the block holding the vote
+
+    def __str__(self):
+        return f'Voter {self.voterhash}'
+
+
 class IBlockchain(ABC):
     DIFFICULTY = 4
+    # Worker processes used for the nonce search, 1 searches in-process
+    MINING_WORKERS = settings.MINING_WORKERS
+    # Nonces handed to a mining worker at a time
+    MINING_CHUNK_SIZE = 2 ** 14
+    # Maximum number of unconfirmed transactions held in the mempool
+    MEMPOOL_CAPACITY = 100000
 
     @abstractmethod
     def create_genesis_block(self) -> None:
@@ -45,6 +58,11 @@ class IBlockchain(ABC):
         """Add a block to the chain if it's valid"""
         pass
 
+    @abstractmethod
+    def add_blocks(self, blocks: List[Any], proofs: List[str]) -> Optional[int]:
+        """Add consecutive blocks to the chain, all of them or none"""
+        pass
+
     @abstractmethod
     def proof_of_work(self, block: Any) -> str:
         """Find a proof that satisfies our proof of work algorithm"""
@@ -55,6 +73,11 @@ class IBlockchain(ABC):
         """Add a new transaction to the list of unconfirmed transactions"""
         pass
 
+    @abstractmethod
+    def add_new_transactions(self, transactions: List[Dict]) -> List[Optional[bool]]:
+        """Add a batch of transactions to the list of unconfirmed transactions"""
+        pass
+
     @abstractmethod
     def check_chain_validity(self, chain: List[Any]) -> bool:
         """Check if the entire blockchain is valid"""
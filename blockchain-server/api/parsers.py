@@ -0,0 +1,17 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from . import wire
+
+
+class BlockWireParser(BaseParser):
+    """
+    Parses blocks sent in the compact binary wire format
+    """
+    media_type = wire.MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return wire.decode(stream.read())
+        except wire.WireFormatError as e:
+            raise ParseError(f"Block message parse error - {str(e)}")
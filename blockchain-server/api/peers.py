@@ -0,0 +1,146 @@
+import logging
+import random
+import threading
+import time
+from typing import Dict, Any, List
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a peer to accept the connection and to send each part of its answer
+PEER_TIMEOUT = (3.05, 10)
+
+
+class PeerClient:
+    """
+    HTTP client of a single peer
+
+    Requests go through one requests.Session, so connections to the peer are
+    kept alive and reused from a pool instead of being opened for every call.
+    Reads are retried with jittered exponential backoff when the connection
+    fails or the peer is temporarily unavailable, writes are sent once.
+    """
+    # Number of connections kept open to the peer
+    POOL_SIZE = 10
+    # Number of extra tries of a failed read
+    RETRIES = 3
+    # Seconds of the first backoff, doubled on every retry up to BACKOFF_MAX
+    BACKOFF_BASE = 0.2
+    BACKOFF_MAX = 2.0
+    # Answers that are worth retrying a read on
+    RETRY_STATUSES = frozenset({502, 503, 504})
+
+    def __init__(self, address: str, pool_size: int = POOL_SIZE, retries: int = RETRIES):
+        """
+        Args:
+            address: Base URL of the peer
+            pool_size: Number of connections kept open to the peer
+            retries: Number of extra tries of a failed read
+        """
+        self.address = address
+        self.retries = retries
+
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._retried = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """Send a GET request to the peer, retried on failure"""
+        for attempt in range(self.retries + 1):
+            last_try = attempt == self.retries
+            try:
+                response = self._request('GET', path, **kwargs)
+            except (ConnectionError, Timeout):
+                if last_try:
+                    raise
+            else:
+                if last_try or response.status_code not in self.RETRY_STATUSES:
+                    return response
+
+            with self._lock:
+                self._retried += 1
+            # Full jitter keeps nodes that failed together from retrying together
+            time.sleep(random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt)))
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """Send a POST request to the peer, never retried"""
+        return self._request('POST', path, **kwargs)
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Send a request and record its latency"""
+        kwargs.setdefault('timeout', PEER_TIMEOUT)
+        started = time.monotonic()
+        try:
+            return self._session.request(method, f'{self.address}{path}', **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            latency = time.monotonic() - started
+            with self._lock:
+                self._requests += 1
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the request, connection and latency counters of the peer"""
+        # The connection pool counts the connections it opened and the requests sent on them
+        pool = self._adapter.poolmanager.connection_from_url(self.address)
+        opened = pool.num_connections
+        sent = pool.num_requests
+
+        with self._lock:
+            return {
+                'address': self.address,
+                'requests': self._requests,
+                'errors': self._errors,
+                'retries': self._retried,
+                'connections_opened': opened,
+                'connections_reused': max(0, sent - opened),
+                'latency_avg_ms': round(self._latency_total / self._requests * 1000, 2) if self._requests else None,
+                'latency_max_ms': round(self._latency_max * 1000, 2),
+            }
+
+    def close(self) -> None:
+        """Close the connections kept open to the peer"""
+        self._session.close()
+
+
+_clients: Dict[str, PeerClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(address: str) -> PeerClient:
+    """
+    Get the client of a peer, created on first use
+
+    Args:
+        address: Base URL of the peer
+
+    Returns:
+        PeerClient: The client shared by every call to that peer
+    """
+    with _clients_lock:
+        client = _clients.get(address)
+        if client is None:
+            client = _clients[address] = PeerClient(address)
+        return client
+
+
+def peer_stats() -> List[Dict[str, Any]]:
+    """Get the stats of every peer called so far"""
+    with _clients_lock:
+        clients = list(_clients.values())
+    return [client.stats() for client in clients]
@@ -0,0 +1,260 @@
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha256
+from typing import Dict, Any, Tuple, Optional, Callable, List
+
+logger = logging.getLogger(__name__)
+
+# Number of nonces a worker tries between two looks at the cancel event
+CANCEL_CHECK_INTERVAL = 4096
+
+# Process pool shared by every parallel search and verification of this process
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_cancel_event = None
+_pool_lock = threading.Lock()
+
+# Cancel event as seen from inside a worker process
+_worker_cancel_event = None
+
+
+def encode_template(fields: Dict[str, Any], nonce_key: str = 'nonce') -> Tuple[bytes, bytes]:
+    """
+    Split the canonical encoding of a block around its nonce
+
+    The canonical encoding is ``json.dumps(fields, sort_keys=True)``. Its top
+    level is rebuilt key by key with the same separators, so that
+    ``prefix + str(nonce).encode() + suffix`` is byte-for-byte what
+    ``json.dumps`` would produce for any nonce.
+
+    Args:
+        fields: The hashed fields of the block, nonce included
+        nonce_key: Name of the nonce field
+
+    Returns:
+        Tuple[bytes, bytes]: The encoded prefix and suffix around the nonce
+    """
+    parts = []
+    nonce_position = None
+
+    for key in sorted(fields):
+        if key == nonce_key:
+            nonce_position = len(parts)
+            parts.append(json.dumps(key) + ': ')
+        else:
+            parts.append(json.dumps(key) + ': ' + json.dumps(fields[key], sort_keys=True))
+
+    if nonce_position is None:
+        raise ValueError(f"Block fields have no '{nonce_key}' key")
+
+    prefix = '{' + ', '.join(parts[:nonce_position + 1])
+    suffix = ''.join(', ' + part for part in parts[nonce_position + 1:]) + '}'
+    return prefix.encode(), suffix.encode()
+
+
+class ProofOfWork:
+    """
+    Nonce search over a pre-serialized block template
+
+    The block is encoded once. The SHA-256 state after the unchanging prefix
+    is kept as a midstate, and every nonce try only copies it and feeds in
+    the nonce digits and the suffix.
+    """
+
+    def __init__(self, fields: Dict[str, Any], difficulty: int):
+        self.prefix, self.suffix = encode_template(fields)
+        self.midstate = sha256(self.prefix)
+        self.difficulty = difficulty
+
+    @classmethod
+    def from_template(cls, prefix: bytes, suffix: bytes, difficulty: int) -> 'ProofOfWork':
+        """Create an engine from an already encoded prefix and suffix"""
+        engine = cls.__new__(cls)
+        engine.prefix = prefix
+        engine.suffix = suffix
+        engine.midstate = sha256(prefix)
+        engine.difficulty = difficulty
+        return engine
+
+    def hash_nonce(self, nonce: int) -> str:
+        """Compute the block hash for the given nonce"""
+        state = self.midstate.copy()
+        state.update(str(nonce).encode() + self.suffix)
+        return state.hexdigest()
+
+    def search(self, start: int = 0, step: int = 1, stop: Optional[int] = None,
+               cancel_event: Any = None) -> Tuple[Optional[int], Optional[str]]:
+        """
+        Try nonces start, start + step, ... until one meets the difficulty
+
+        Args:
+            start: First nonce to try
+            step: Distance between two consecutive tries
+            stop: Nonce at which to give up (exclusive), None to search forever
+            cancel_event: Event that aborts the search once set
+
+        Returns:
+            Tuple[Optional[int], Optional[str]]: The (nonce, hash) pair found,
+            or (None, None) if the range was exhausted or the search cancelled
+        """
+        midstate = self.midstate
+        suffix = self.suffix
+        # A hex prefix of d zeros is d // 2 zero bytes plus, for odd d,
+        # one byte below 0x10, so the hexdigest is only built on success
+        zero_bytes = bytes(self.difficulty // 2)
+        half_byte = self.difficulty % 2
+        zero_len = len(zero_bytes)
+
+        nonce = start
+        tries = 0
+        while stop is None or nonce < stop:
+            state = midstate.copy()
+            state.update(str(nonce).encode() + suffix)
+            digest = state.digest()
+            if digest[:zero_len] == zero_bytes and (not half_byte or digest[zero_len] < 0x10):
+                return nonce, digest.hex()
+            nonce += step
+
+            tries += 1
+            if cancel_event is not None and tries % CANCEL_CHECK_INTERVAL == 0 and cancel_event.is_set():
+                break
+
+        return None, None
+
+    def parallel_search(self, workers: int, chunk_size: int) -> Tuple[int, str]:
+        """
+        Search the nonce space on a pool of worker processes
+
+        The nonce space is cut into consecutive chunks of chunk_size nonces
+        that are handed out to the workers. Once one of them finds a hash
+        meeting the difficulty, chunks still queued are cancelled and running
+        ones are told to stop. With a single worker the search runs in the
+        calling process.
+
+        Args:
+            workers: Number of worker processes
+            chunk_size: Number of nonces per chunk
+
+        Returns:
+            Tuple[int, str]: The (nonce, hash) pair found
+        """
+        if workers <= 1:
+            return self.search()
+
+        with _pool_lock:
+            try:
+                return self._run_on_pool(workers, chunk_size)
+            except BrokenProcessPool:
+                logger.warning("Mining pool broke, falling back to single process search")
+                _reset_pool()
+
+        return self.search()
+
+    def _run_on_pool(self, workers: int, chunk_size: int) -> Tuple[int, str]:
+        """Hand out nonce chunks to the pool until one of them succeeds"""
+        pool, cancel_event = _get_pool(workers)
+        cancel_event.clear()
+
+        pending = set()
+        next_start = 0
+        found = None
+
+        def submit_chunk():
+            nonlocal next_start
+            pending.add(pool.submit(_search_range, self.prefix, self.suffix, self.difficulty,
+                                    next_start, next_start + chunk_size))
+            next_start += chunk_size
+
+        # Keep two chunks per worker in flight so no worker waits for a new one
+        for _ in range(workers * 2):
+            submit_chunk()
+
+        try:
+            while found is None:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    nonce, computed_hash = future.result()
+                    if nonce is not None and found is None:
+                        found = (nonce, computed_hash)
+                if found is None:
+                    for _ in done:
+                        submit_chunk()
+        finally:
+            cancel_event.set()
+            for future in pending:
+                future.cancel()
+            wait(pending)
+
+        return found
+
+
+def map_on_pool(fn: Callable[[Any], Any], chunks: List[Any], workers: int) -> List[Any]:
+    """
+    Run a function over chunks of work on the shared process pool
+
+    Args:
+        fn: Module level function applied to every chunk
+        chunks: The chunks of work, each pickled to a worker
+        workers: Number of worker processes
+
+    Returns:
+        List[Any]: The results, in the order of the chunks
+
+    Raises:
+        BrokenProcessPool: If a worker died, the pool is reset first
+    """
+    with _pool_lock:
+        pool, _ = _get_pool(workers)
+        try:
+            return list(pool.map(fn, chunks))
+        except BrokenProcessPool:
+            _reset_pool()
+            raise
+
+
+def _init_worker(cancel_event: Any) -> None:
+    """Keep the shared cancel event of the pool in the worker process"""
+    global _worker_cancel_event
+    _worker_cancel_event = cancel_event
+
+
+def _search_range(prefix: bytes, suffix: bytes, difficulty: int,
+                  start: int, stop: int) -> Tuple[Optional[int], Optional[str]]:
+    """Search one chunk of the nonce space inside a worker process"""
+    engine = ProofOfWork.from_template(prefix, suffix, difficulty)
+    return engine.search(start, 1, stop, cancel_event=_worker_cancel_event)
+
+
+def _get_pool(workers: int) -> Tuple[ProcessPoolExecutor, Any]:
+    """
+    Get the shared process pool, creating it if the worker count changed
+
+    Workers are started from a fresh interpreter rather than forked, since
+    forking a server whose other threads hold locks can leave the children
+    stuck on those locks.
+    """
+    global _pool, _pool_workers, _pool_cancel_event
+    if _pool is None or _pool_workers != workers:
+        _reset_pool()
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        _pool_cancel_event = context.Event()
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                    initializer=_init_worker, initargs=(_pool_cancel_event,))
+        _pool_workers = workers
+        logger.info(f"Started mining pool with {workers} workers")
+    return _pool, _pool_cancel_event
+
+
+def _reset_pool() -> None:
+    """Shut the shared process pool down"""
+    global _pool, _pool_workers
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+    _pool_workers = 0
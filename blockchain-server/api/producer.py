@@ -0,0 +1,150 @@
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, Dict, Any, Optional
+
+from .models import IBlockchain
+from .helpers import mine_and_announce
+
+logger = logging.getLogger(__name__)
+
+
+class BlockProducer:
+    """
+    Background thread that seals blocks from the pending transactions
+
+    A block is sealed once batch_size transactions are pending, or once the
+    oldest pending transaction has waited max_wait seconds, whichever comes
+    first. request_mine() asks for a block to be sealed right away.
+    """
+    # Seconds between two looks at the pending transactions when nothing notifies the producer
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, get_blockchain: Callable[[], IBlockchain], batch_size: int, max_wait: float):
+        """
+        Args:
+            get_blockchain: Returns the blockchain blocks are sealed on, looked
+                up on every round since the node may replace it
+            batch_size: Number of pending transactions that triggers a block
+            max_wait: Seconds the oldest pending transaction may wait for a block
+        """
+        self._get_blockchain = get_blockchain
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._mine_requested = False
+        self._pending_since: Optional[float] = None
+
+        self.state = 'idle'
+        self.current_batch_size = 0
+        self.last_block_time: Optional[datetime.datetime] = None
+        self.last_block_index: Optional[int] = None
+        self.blocks_sealed = 0
+
+    @property
+    def is_running(self) -> bool:
+        """Check if the producer thread is alive"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Start the producer thread"""
+        if self.is_running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='block-producer', daemon=True)
+        self._thread.start()
+        logger.info(f"Block producer started (batch size {self.batch_size}, max wait {self.max_wait}s)")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the producer thread once its current round is over"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def notify(self) -> None:
+        """Tell the producer that new transactions are pending"""
+        self._wakeup.set()
+
+    def request_mine(self) -> None:
+        """Ask the producer to seal the pending transactions right away"""
+        self._mine_requested = True
+        self._wakeup.set()
+
+    def status(self) -> Dict[str, Any]:
+        """Get the current state of the producer"""
+        return {
+            'running': self.is_running,
+            'state': self.state,
+            'pending_transactions': len(self._get_blockchain().unconfirmed_transactions),
+            'current_batch_size': self.current_batch_size,
+            'last_block_index': self.last_block_index,
+            'last_block_time': str(self.last_block_time) if self.last_block_time else None,
+            'blocks_sealed': self.blocks_sealed,
+            'batch_size': self.batch_size,
+            'max_wait': self.max_wait,
+        }
+
+    def _run(self) -> None:
+        """Seal blocks until the producer is stopped"""
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._next_timeout())
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+
+            try:
+                blockchain = self._get_blockchain()
+                if self._should_seal(blockchain):
+                    self._seal(blockchain)
+            except Exception as e:
+                logger.error(f"Block producer round failed: {str(e)}")
+
+    def _next_timeout(self) -> float:
+        """Get how long to sleep before the next look at the pending transactions"""
+        if self._pending_since is None:
+            return self.POLL_INTERVAL
+        deadline = self._pending_since + self.max_wait
+        return max(0.0, min(self.POLL_INTERVAL, deadline - time.monotonic()))
+
+    def _should_seal(self, blockchain: IBlockchain) -> bool:
+        """Check if the pending transactions should be sealed into a block now"""
+        pending = len(blockchain.unconfirmed_transactions)
+        if not pending:
+            self._pending_since = None
+            self._mine_requested = False
+            return False
+
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+        if self._mine_requested or pending >= self.batch_size:
+            return True
+
+        return time.monotonic() - self._pending_since >= self.max_wait
+
+    def _seal(self, blockchain: IBlockchain) -> None:
+        """Mine the pending transactions and announce the new blocks"""
+        self._mine_requested = False
+        self.state = 'mining'
+        self.current_batch_size = len(blockchain.unconfirmed_transactions)
+        prev_length = blockchain.state.length
+
+        try:
+            if mine_and_announce(blockchain):
+                chain_state = blockchain.state
+                self.blocks_sealed += max(0, chain_state.length - prev_length)
+                self.last_block_index = chain_state.last_block.index
+                self.last_block_time = datetime.datetime.now()
+                logger.info(f"Block producer sealed block #{self.last_block_index} "
+                            f"with {self.current_batch_size} pending transactions")
+        finally:
+            self.state = 'idle'
+            self.current_batch_size = 0
+            # Transactions that arrived while mining start a new wait
+            self._pending_since = time.monotonic() if blockchain.unconfirmed_transactions else None
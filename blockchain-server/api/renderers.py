@@ -0,0 +1,33 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from . import wire
+
+
+class BlockWireRenderer(BaseRenderer):
+    """
+    Renders blocks in the compact binary wire format
+
+    Chain documents ({"length", "chain", "peers"}), ranges of a chain that
+    also carry since_height and next_cursor, and single blocks are encoded,
+    anything else such as an error is rendered as JSON.
+    """
+    media_type = wire.MEDIA_TYPE
+    format = 'svb'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict) and 'chain' in data and 'since_height' in data:
+            return wire.encode(data['chain'], wire.KIND_RANGE, data.get('length'), tuple(data.get('peers', ())),
+                               data['since_height'], data.get('next_cursor'))
+
+        if isinstance(data, dict) and 'chain' in data:
+            return wire.encode(data['chain'], wire.KIND_CHAIN, data.get('length'), tuple(data.get('peers', ())))
+
+        if isinstance(data, dict) and 'transactions' in data:
+            return wire.encode([data], wire.KIND_BLOCK)
+
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = 'application/json'
+        return JSONRenderer().render(data)
@@ -3,7 +3,7 @@ from rest_framework import serializers
 class TransactionSerializer(serializers.Serializer):
     candidate = serializers.CharField(required=True)
     voterhash = serializers.CharField(required=True)
-    timestamp = serializers.CharField(read_only=True)
+    timestamp = serializers.CharField(required=False)
 
     def validate_voterhash(self, value):
         if not value:
@@ -16,12 +16,62 @@ class BlockSerializer(serializers.Serializer):
     timestamp = serializers.CharField(required=True)
     previous_hash = serializers.CharField(required=True)
     nonce = serializers.IntegerField(required=True)
-    blockhash = serializers.CharField(required=True, write_only=True)
+    merkle_root = serializers.CharField(required=False, allow_null=True, default=None)
+    blockhash = serializers.CharField(required=True)
+
+class BlockBatchSerializer(serializers.Serializer):
+    chain = BlockSerializer(many=True, allow_empty=False)
 
 class ChainSerializer(serializers.Serializer):
     length = serializers.IntegerField()
     chain = BlockSerializer(many=True)
     peers = serializers.ListField(child=serializers.CharField())
+    since_height = serializers.IntegerField(required=False)
+    next_cursor = serializers.IntegerField(required=False, allow_null=True)
+
+class ChainRangeSerializer(serializers.Serializer):
+    since_height = serializers.IntegerField(required=False, min_value=0, default=0)
+    limit = serializers.IntegerField(required=False, min_value=1)
+
+class BlockHeaderSerializer(serializers.Serializer):
+    index = serializers.IntegerField()
+    timestamp = serializers.CharField()
+    previous_hash = serializers.CharField()
+    nonce = serializers.IntegerField()
+    merkle_root = serializers.CharField(allow_null=True)
+    blockhash = serializers.CharField()
+
+class HeadersSerializer(serializers.Serializer):
+    length = serializers.IntegerField()
+    headers = BlockHeaderSerializer(many=True)
+    next_cursor = serializers.IntegerField(allow_null=True)
+
+class TipSerializer(serializers.Serializer):
+    length = serializers.IntegerField()
+    height = serializers.IntegerField()
+    blockhash = serializers.CharField()
+
+class MerklePathStepSerializer(serializers.Serializer):
+    hash = serializers.CharField()
+    position = serializers.ChoiceField(choices=['left', 'right'])
+
+class VoteProofSerializer(serializers.Serializer):
+    block_header = BlockHeaderSerializer()
+    transaction = serializers.DictField()
+    transaction_index = serializers.IntegerField()
+    merkle_path = MerklePathStepSerializer(many=True)
+
+class VoteStatusSerializer(serializers.Serializer):
+    voterhash = serializers.CharField()
+    status = serializers.ChoiceField(choices=['confirmed', 'pending', 'unknown'])
+    block_index = serializers.IntegerField(allow_null=True)
+    blockhash = serializers.CharField(allow_null=True)
+    confirmations = serializers.IntegerField()
+
+class TallySerializer(serializers.Serializer):
+    height = serializers.IntegerField()
+    total_votes = serializers.IntegerField()
+    tally = serializers.DictField(child=serializers.IntegerField())
 
 class NodeRegistrationSerializer(serializers.Serializer):
     node_address = serializers.CharField(required=True)
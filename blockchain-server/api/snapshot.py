@@ -0,0 +1,255 @@
+import datetime
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from .blockchain import Blockchain, Block
+from . import wire
+
+logger = logging.getLogger(__name__)
+
+# snapshot := MAGIC version uint32(crc32 of body) body
+# body     := uint32(metadata size) metadata(JSON) chain(wire chain message)
+MAGIC = b'SVS'
+VERSION = 1
+HEADER = struct.Struct('<I')
+
+PREFIX = 'snapshot-'
+SUFFIX = '.svs'
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot file is damaged or of another version"""
+    pass
+
+
+def encode_snapshot(blocks: List[Block], peers: List[str], mempool: List[Dict]) -> bytes:
+    """
+    Encode the state of a node into a snapshot
+
+    Args:
+        blocks: The chain
+        peers: The peer addresses
+        mempool: The pending transactions, oldest first
+
+    Returns:
+        bytes: The encoded snapshot
+    """
+    metadata = json.dumps({
+        'height': len(blocks) - 1,
+        'blockhash': blocks[-1].blockhash if blocks else None,
+        'created': str(datetime.datetime.now()),
+        'mempool': mempool,
+    }).encode()
+    chain = wire.encode([block.to_dict() for block in blocks], wire.KIND_CHAIN, peers=tuple(peers))
+    body = HEADER.pack(len(metadata)) + metadata + chain
+    return MAGIC + bytes([VERSION]) + HEADER.pack(zlib.crc32(body)) + body
+
+
+def decode_snapshot(data: bytes) -> Tuple[List[Block], List[str], List[Dict]]:
+    """
+    Decode a snapshot
+
+    Args:
+        data: The encoded snapshot
+
+    Returns:
+        Tuple[List[Block], List[str], List[Dict]]: The chain, the peers and
+        the pending transactions
+
+    Raises:
+        SnapshotError: If the snapshot is damaged or of another version
+    """
+    start = len(MAGIC) + 1 + HEADER.size
+    if len(data) < start or data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError("Not a snapshot")
+    if data[len(MAGIC)] != VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {data[len(MAGIC)]}")
+
+    crc, = HEADER.unpack_from(data, len(MAGIC) + 1)
+    body = memoryview(data)[start:]
+    if zlib.crc32(body) != crc:
+        raise SnapshotError("Snapshot checksum mismatch")
+
+    metadata_size, = HEADER.unpack_from(body)
+    metadata = json.loads(bytes(body[HEADER.size:HEADER.size + metadata_size]))
+    try:
+        chain = wire.decode(body[HEADER.size + metadata_size:])
+    except wire.WireFormatError as e:
+        raise SnapshotError(f"Snapshot chain is damaged: {str(e)}")
+
+    blocks = [Block.from_json(block) for block in chain['chain']]
+    return blocks, chain['peers'], metadata['mempool']
+
+
+def snapshot_paths(directory: str) -> List[str]:
+    """Get the snapshot files of a directory, newest first by sequence number"""
+    if not os.path.isdir(directory):
+        return []
+    names = sorted((name for name in os.listdir(directory) if name.startswith(PREFIX) and name.endswith(SUFFIX)),
+                   reverse=True)
+    return [os.path.join(directory, name) for name in names]
+
+
+def write_snapshot(blockchain: Blockchain, directory: str, keep: int = 3) -> str:
+    """
+    Write a snapshot of a node atomically
+
+    The snapshot is written to a temporary file that is flushed to disk and
+    then renamed over its final name, so a crash never leaves a half written
+    snapshot behind. Snapshots are numbered in the order they are written
+    and only the newest keep snapshots are kept.
+
+    Args:
+        blockchain: The node's blockchain
+        directory: Directory holding the snapshots, created if missing
+        keep: Number of snapshots to keep
+
+    Returns:
+        str: Path of the new snapshot
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    # One published state is taken, blocks appended meanwhile are left for the next snapshot
+    blocks = blockchain.state.blocks()
+    data = encode_snapshot(blocks, list(set(blockchain.nodes)), list(blockchain.unconfirmed_transactions))
+
+    # Named by sequence number rather than height, a reset chain's snapshot is still the newest
+    existing = snapshot_paths(directory)
+    sequence = int(os.path.basename(existing[0])[len(PREFIX):-len(SUFFIX)]) + 1 if existing else 0
+    path = os.path.join(directory, f'{PREFIX}{sequence:020d}{SUFFIX}')
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as snapshot:
+        snapshot.write(data)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary_path, path)
+
+    # Make the rename itself durable
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+    for old_path in snapshot_paths(directory)[keep:]:
+        os.remove(old_path)
+
+    return path
+
+
+def load_latest_snapshot(directory: str) -> Optional[Blockchain]:
+    """
+    Restore a node from its newest valid snapshot
+
+    Damaged snapshots are skipped in favour of older ones. already_voted and
+    the tally are rebuilt from the snapshot's blocks while they are loaded,
+    and pending transactions whose vote is already on the chain are dropped.
+
+    Args:
+        directory: Directory holding the snapshots
+
+    Returns:
+        Optional[Blockchain]: The restored blockchain, None if there is no
+        valid snapshot
+    """
+    for path in snapshot_paths(directory):
+        try:
+            with open(path, 'rb') as snapshot:
+                blocks, peers, mempool = decode_snapshot(snapshot.read())
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Skipping snapshot {path}: {str(e)}")
+            continue
+
+        if not blocks:
+            continue
+
+        blockchain = Blockchain()
+        # Blocks may have been tampered with before the snapshot, they are
+        # verified by the first validity check rather than on the boot path
+        blockchain.replace_chain(blocks)
+        for peer in peers:
+            blockchain.add_peer(peer)
+        blockchain.add_new_transactions([
+            transaction for transaction in mempool
+            if transaction.get('voterhash') not in blockchain.already_voted
+        ])
+
+        logger.info(f"Restored {len(blocks)} blocks from snapshot {path}")
+        return blockchain
+
+    return None
+
+
+class Snapshotter:
+    """
+    Background thread that snapshots the node every interval seconds
+
+    A snapshot is only written when the chain or the pending transactions
+    changed since the previous one.
+    """
+
+    def __init__(self, get_blockchain: Callable[[], Blockchain], directory: str, interval: float, keep: int = 3):
+        """
+        Args:
+            get_blockchain: Returns the blockchain to snapshot, looked up on
+                every round since the node may replace it
+            directory: Directory holding the snapshots
+            interval: Seconds between two snapshots
+            keep: Number of snapshots to keep
+        """
+        self._get_blockchain = get_blockchain
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_state: Optional[Tuple[Any, ...]] = None
+
+    @property
+    def is_running(self) -> bool:
+        """Check if the snapshot thread is alive"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Start the snapshot thread"""
+        if self.is_running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='snapshotter', daemon=True)
+        self._thread.start()
+        logger.info(f"Snapshotter started (every {self.interval}s into {self.directory})")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the snapshot thread"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def snapshot(self) -> Optional[str]:
+        """Write a snapshot now if anything changed, returns its path"""
+        blockchain = self._get_blockchain()
+        chain_state = blockchain.state
+        state = (id(blockchain), chain_state.length, chain_state.last_block.blockhash,
+                 len(blockchain.unconfirmed_transactions), len(blockchain.nodes))
+        if state == self._last_state:
+            return None
+
+        path = write_snapshot(blockchain, self.directory, self.keep)
+        self._last_state = state
+        logger.info(f"Wrote snapshot {path}")
+        return path
+
+    def _run(self) -> None:
+        """Write snapshots until the thread is stopped"""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                logger.error(f"Snapshot failed: {str(e)}")
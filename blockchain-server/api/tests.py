@@ -1,3 +1,862 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.test import SimpleTestCase, TestCase, override_settings
+from requests.exceptions import ConnectionError
+from rest_framework.test import APIClient
+
+from . import helpers, views, wire
+from .apps import _is_serving_process
+from .blockchain import Blockchain, Block
+from .blockchain_log import BlockchainLog, INDEX_SUFFIX
+from .blockchain_persistent import BlockchainPersistent
+from .gossip import Gossip
+from .mempool import Mempool, MempoolFull
+from .peers import PeerClient, PEER_TIMEOUT
+from .merkle import merkle_root, merkle_path, verify_merkle_path
+from . import pow as pow_engine
+from .models import Voter
+from .snapshot import write_snapshot, load_latest_snapshot, snapshot_paths
+from .writer import ChainWriter, on_writer
+
+
+def vote(voter_hash, candidate='Alice'):
+    return {'candidate': candidate, 'voterhash': voter_hash}
+
+
+def copy_block(block):
+    """Copy a block the way it travels between nodes"""
+    return Block.from_json(block.to_dict())
+
+
+def easy_mining(engine):
+    """Mine in-process at the lowest difficulty"""
+    return mock.patch.multiple(engine, DIFFICULTY=1, MINING_WORKERS=1)
+
+
+def sealed_block(previous, voter_hashes, difficulty=1):
+    """Make a block on top of previous and find its proof"""
+    block = Block(previous.index + 1, [vote(voter_hash) for voter_hash in voter_hashes], 't', previous.blockhash)
+    block.merkle_root = block.transactions_root()
+    nonce = 0
+    while True:
+        block.nonce = nonce
+        proof = block.compute_hash()
+        if proof.startswith('0' * difficulty):
+            return block, proof
+        nonce += 1
+
+
+class MiningTests(SimpleTestCase):
+    def setUp(self):
+        patcher = easy_mining(Blockchain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blockchain = Blockchain()
+        self.blockchain.create_genesis_block()
+
+    def test_vote_confirmed_by_a_peer_while_mining_is_not_mined_again(self):
+        peer = Blockchain()
+        peer.replace_chain([copy_block(self.blockchain.last_block)])
+        peer.add_new_transaction(vote('V', 'X'))
+        peer.mine()
+        peer_block = peer.last_block
+
+        self.blockchain.add_new_transaction(vote('V', 'X'))
+        proof_of_work = self.blockchain.proof_of_work
+
+        def peer_block_arrives(block):
+            proof = proof_of_work(block)
+            self.blockchain.add_block(copy_block(peer_block), peer_block.blockhash)
+            return proof
+
+        with mock.patch.object(self.blockchain, 'proof_of_work', peer_block_arrives):
+            self.assertFalse(self.blockchain.mine())
+
+        self.assertFalse(self.blockchain.mine())
+        voters = [tx['voterhash'] for block in self.blockchain.chain for tx in block.transactions]
+        self.assertEqual(voters, ['V'])
+        self.assertEqual(self.blockchain.state.tally, {'X': 1})
+
+    def test_failed_proof_of_work_requeues_the_batch(self):
+        self.blockchain.add_new_transaction(vote('V'))
+        with mock.patch.object(self.blockchain, 'proof_of_work', side_effect=RuntimeError('pool broke')):
+            self.assertFalse(self.blockchain.mine())
+        self.assertIn('V', self.blockchain.unconfirmed_transactions)
+        self.assertFalse(self.blockchain.is_mining)
+
+    def test_pending_votes_are_packed_into_full_blocks(self):
+        self.blockchain.add_new_transactions([vote(voter_hash) for voter_hash in 'ABCDE'])
+
+        with mock.patch.object(Blockchain, 'MAX_BLOCK_TRANSACTIONS', 2):
+            self.assertTrue(self.blockchain.mine())
+
+        self.assertEqual([len(block.transactions) for block in self.blockchain.chain[1:]], [2, 2, 1])
+        self.assertEqual(self.blockchain.state.tally, {'Alice': 5})
+        self.assertFalse(self.blockchain.unconfirmed_transactions)
+
+    def test_mempool_rejects_duplicates_and_overflow(self):
+        mempool = Mempool(2)
+        self.assertTrue(mempool.add(vote('A')))
+        self.assertFalse(mempool.add(vote('A', 'Bob')))
+        self.assertEqual(mempool.add_many([vote('B'), vote('B'), vote('C')]), [True, False, None])
+        with self.assertRaises(MempoolFull):
+            mempool.add(vote('D'))
+
+        self.assertEqual(mempool.get('A')['candidate'], 'Alice')
+        self.assertEqual([tx['voterhash'] for tx in mempool.pop_n(5)], ['A', 'B'])
+
+    def test_requeue_skips_excluded_voters(self):
+        mempool = Mempool(10)
+        mempool.add(vote('A'))
+        mempool.add(vote('B'))
+        taken = mempool.pop_n(2)
+        mempool.requeue(taken, exclude={'A'})
+        self.assertEqual([tx['voterhash'] for tx in mempool], ['B'])
+
+
+class ProofOfWorkTests(SimpleTestCase):
+    def test_one_mining_worker_by_default(self):
+        self.assertEqual(Blockchain.MINING_WORKERS, 1)
+
+    def test_template_hashes_match_compute_hash(self):
+        block = Block(1, [vote('A'), vote('B', 'Bob')], 't', '0' * 64)
+        for merkle_root in (None, block.transactions_root()):
+            block.merkle_root = merkle_root
+            engine = pow_engine.ProofOfWork(block.hash_fields(), 2)
+            for nonce in (0, 7, 12345, 10 ** 12):
+                block.nonce = nonce
+                self.assertEqual(engine.prefix + str(nonce).encode() + engine.suffix, block.encode())
+                self.assertEqual(engine.hash_nonce(nonce), block.compute_hash())
+
+            nonce, block_hash = engine.search()
+            block.nonce = nonce
+            self.assertEqual(block.compute_hash(), block_hash)
+            self.assertTrue(block.is_valid_proof(block_hash, 2))
+
+    def test_parallel_search_finds_the_block_hash(self):
+        self.addCleanup(pow_engine._reset_pool)
+        block = Block(1, [vote('A')], 't', '0' * 64)
+        block.merkle_root = block.transactions_root()
+
+        nonce, block_hash = pow_engine.ProofOfWork(block.hash_fields(), 2).parallel_search(2, 64)
+
+        self.assertIn(pow_engine._pool._mp_context.get_start_method(), ('forkserver', 'spawn'))
+        block.nonce = nonce
+        self.assertEqual(block.compute_hash(), block_hash)
+        self.assertTrue(block.is_valid_proof(block_hash, 2))
+
+
+class MerkleTests(SimpleTestCase):
+    def test_every_path_leads_to_the_root(self):
+        for size in range(1, 8):
+            transactions = [vote(f'v{i}') for i in range(size)]
+            root = merkle_root(transactions)
+            for position, transaction in enumerate(transactions):
+                path = merkle_path(transactions, position)
+                self.assertTrue(verify_merkle_path(transaction, path, root))
+                self.assertFalse(verify_merkle_path(vote(f'v{position}', 'Hacker'), path, root))
+
+    def test_vote_proof_verifies_against_the_block_hash(self):
+        with easy_mining(Blockchain):
+            blockchain = Blockchain()
+            blockchain.create_genesis_block()
+            blockchain.add_new_transactions([vote(voter_hash) for voter_hash in 'ABC'])
+            blockchain.mine()
+
+        with mock.patch.object(views, 'blockchain', blockchain):
+            client = APIClient()
+            proof = client.get('/vote_proof/B/').json()
+            self.assertEqual(client.get('/vote_proof/Z/').status_code, 404)
+
+        header = proof['block_header']
+        self.assertEqual(proof['transaction']['voterhash'], 'B')
+        self.assertTrue(verify_merkle_path(proof['transaction'], proof['merkle_path'], header['merkle_root']))
+        block = Block(header['index'], [], header['timestamp'], header['previous_hash'], header['nonce'],
+                      merkle_root=header['merkle_root'])
+        self.assertEqual(block.compute_hash(), header['blockhash'])
+
+
+class ChainStateTests(SimpleTestCase):
+    def setUp(self):
+        patcher = easy_mining(Blockchain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blockchain = Blockchain()
+        self.blockchain.create_genesis_block()
+
+    def test_published_state_is_not_changed_by_later_writes(self):
+        state = self.blockchain.state
+        self.blockchain.add_new_transaction(vote('A'))
+        self.blockchain.mine()
+
+        self.assertIsInstance(state.chain, tuple)
+        self.assertEqual((len(state.chain), state.length), (1, 1))
+        self.assertEqual(self.blockchain.state.length, 2)
+
+    def test_replaced_suffix_of_the_same_length_is_published(self):
+        genesis = self.blockchain.last_block
+        self.blockchain.add_new_transaction(vote('A'))
+        self.blockchain.mine()
+        mined = self.blockchain.state
+        other, proof = sealed_block(genesis, ['B'])
+        other.blockhash = proof
+
+        self.assertTrue(self.blockchain.replace_suffix(0, [other], 2))
+
+        self.assertEqual(mined.chain[1].transactions[0]['voterhash'], 'A')
+        self.assertIs(self.blockchain.state.chain[1], other)
+        self.assertEqual(self.blockchain.state.tally, {'Alice': 1})
+
+
+class TamperTests(SimpleTestCase):
+    def test_transactions_edited_in_place_are_caught(self):
+        with easy_mining(Blockchain):
+            blockchain = Blockchain()
+            blockchain.create_genesis_block()
+            blockchain.add_new_transaction(vote('V'))
+            blockchain.mine()
+            self.assertTrue(blockchain.verify_chain())
+
+            blockchain.chain[1].transactions[0]['candidate'] = 'Hacker'
+
+            self.assertFalse(blockchain.verify_chain())
+            self.assertFalse(blockchain.verify_chain(full=True))
+            self.assertFalse(blockchain.check_chain_validity(blockchain.chain))
+
+    def test_only_unverified_and_edited_blocks_are_checked(self):
+        with easy_mining(Blockchain):
+            miner = Blockchain()
+            miner.create_genesis_block()
+            for voter_hash in 'ABCD':
+                miner.add_new_transaction(vote(voter_hash))
+                miner.mine()
+            blockchain = Blockchain()
+            blockchain.replace_chain([copy_block(block) for block in miner.chain[:4]])
+            checked = []
+            is_valid_proof = blockchain._is_valid_proof
+
+            def record(block, block_hash, audit=False):
+                checked.append(block.index)
+                return is_valid_proof(block, block_hash, audit)
+
+            with mock.patch.object(blockchain, '_is_valid_proof', record):
+                self.assertTrue(blockchain.verify_chain())
+                self.assertEqual(checked, [1, 2, 3])
+
+                # Blocks added through add_block are checked on the way in
+                checked.clear()
+                self.assertTrue(blockchain.add_block(copy_block(miner.chain[4]), miner.chain[4].blockhash))
+                self.assertTrue(blockchain.verify_chain())
+                self.assertEqual(checked, [4])
+
+                checked.clear()
+                blockchain.update_block(2, nonce=blockchain.chain[2].nonce + 1)
+                self.assertEqual(blockchain.first_invalid_height(), 2)
+                self.assertEqual(checked, [2])
+
+    def test_parallel_check_fails_at_the_same_block_as_the_serial_one(self):
+        self.addCleanup(pow_engine._reset_pool)
+        with easy_mining(Blockchain):
+            blockchain = Blockchain()
+            blockchain.create_genesis_block()
+            for voter_hash in 'ABCDEFG':
+                blockchain.add_new_transaction(vote(voter_hash))
+                blockchain.mine()
+
+        def failing_block(chain, workers):
+            with mock.patch.multiple(Blockchain, DIFFICULTY=1, MINING_WORKERS=workers, PARALLEL_VERIFY_MIN_BLOCKS=2,
+                                     PARALLEL_VERIFY_CHUNK_SIZE=2):
+                with self.assertLogs('api.blockchain', 'WARNING') as logs:
+                    self.assertFalse(blockchain.check_chain_validity(chain))
+            return logs.output[-1]
+
+        edits = [
+            lambda chain: chain[5].transactions[0].update(candidate='Hacker'),
+            lambda chain: chain[3].transactions[0].update(candidate='Hacker'),
+            lambda chain: setattr(chain[2], 'previous_hash', '0' * 64),
+        ]
+        chain = [copy_block(block) for block in blockchain.chain]
+        for edit, index in zip(edits, (5, 3, 2)):
+            edit(chain)
+            self.assertTrue(failing_block(chain, 2).endswith(f'failed at block {index}'))
+            self.assertEqual(failing_block(chain, 2), failing_block(chain, 1))
+        self.assertIsNotNone(pow_engine._pool)
+
+    def test_tamper_endpoint_is_caught_by_the_default_check(self):
+        with easy_mining(Blockchain):
+            blockchain = Blockchain()
+            blockchain.create_genesis_block()
+            blockchain.add_new_transaction(vote('V'))
+            blockchain.mine()
+            self.assertTrue(blockchain.verify_chain())
+
+            client = APIClient()
+            with mock.patch.object(views, 'blockchain', blockchain):
+                self.assertEqual(client.get('/tamper_block/').status_code, 200)
+                self.assertEqual(client.get('/chain_validity/').status_code, 400)
+
+            self.assertEqual(blockchain.chain[1].transactions[0]['candidate'], 'Hacker')
+            self.assertFalse(blockchain.verify_chain())
+
+
+class SnapshotTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = easy_mining(Blockchain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blockchain = Blockchain()
+        self.blockchain.create_genesis_block()
+
+    def mine_votes(self, *voter_hashes):
+        self.blockchain.add_new_transactions([vote(voter_hash) for voter_hash in voter_hashes])
+        self.blockchain.mine()
+
+    def test_round_trip(self):
+        self.mine_votes('A', 'B')
+        self.blockchain.add_peer('http://peer:8000')
+        self.blockchain.add_new_transaction(vote('C'))
+        write_snapshot(self.blockchain, self.directory)
+
+        restored = load_latest_snapshot(self.directory)
+
+        self.assertEqual(restored.last_block.blockhash, self.blockchain.last_block.blockhash)
+        self.assertEqual(restored.already_voted, {'A', 'B'})
+        self.assertEqual(restored.nodes, {'http://peer:8000'})
+        self.assertEqual([tx['voterhash'] for tx in restored.unconfirmed_transactions], ['C'])
+        self.assertTrue(restored.verify_chain())
+
+    def test_damaged_snapshot_falls_back_to_the_previous_one(self):
+        self.mine_votes('A')
+        write_snapshot(self.blockchain, self.directory)
+        self.mine_votes('B')
+        newest = write_snapshot(self.blockchain, self.directory)
+        with open(newest, 'r+b') as snapshot:
+            snapshot.seek(40)
+            snapshot.write(b'XX')
+
+        self.assertEqual(len(load_latest_snapshot(self.directory).chain), 2)
+
+    def test_snapshot_after_reset_is_kept(self):
+        for voter_hash in 'ABCD':
+            self.mine_votes(voter_hash)
+            write_snapshot(self.blockchain, self.directory)
+
+        self.blockchain.reset()
+        path = write_snapshot(self.blockchain, self.directory)
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(len(snapshot_paths(self.directory)), 3)
+        self.assertEqual(len(load_latest_snapshot(self.directory).chain), 1)
+
+    def test_only_serving_processes_restore_the_snapshot(self):
+        config = apps.get_app_config('api')
+        with mock.patch.multiple(views, restore_snapshot=mock.DEFAULT, block_producer=mock.DEFAULT,
+                                 snapshotter=mock.DEFAULT, gossip=mock.DEFAULT) as mocks:
+            with mock.patch('api.apps._is_serving_process', return_value=False):
+                config.ready()
+            mocks['restore_snapshot'].assert_not_called()
+
+            with mock.patch('api.apps._is_serving_process', return_value=True):
+                config.ready()
+            mocks['restore_snapshot'].assert_called_once_with()
+
+    def test_restore_replaces_the_views_blockchain(self):
+        self.mine_votes('A')
+        write_snapshot(self.blockchain, self.directory)
+
+        with mock.patch.object(views, 'blockchain', views.blockchain), override_settings(SNAPSHOT_DIR=self.directory):
+            views.restore_snapshot()
+            self.assertEqual(views.blockchain.state.last_block.blockhash, self.blockchain.last_block.blockhash)
+
+
+class WireTests(SimpleTestCase):
+    block = {
+        'index': 1,
+        'transactions': [{'candidate': 'Alice', 'voterhash': 'v', 'note': 'abcd'}],
+        'timestamp': 't',
+        'previous_hash': '0' * 64,
+        'nonce': 7,
+        'blockhash': 'f' * 64,
+        'merkle_root': None
+    }
+
+    def test_round_trip(self):
+        self.assertEqual(wire.decode(wire.encode([self.block], wire.KIND_BLOCK)), self.block)
+        message = wire.decode(wire.encode([self.block], peers=('http://peer',)))
+        self.assertEqual(message, {'length': 1, 'chain': [self.block], 'peers': ['http://peer']})
+
+    def test_malformed_bodies(self):
+        data = wire.encode([self.block], wire.KIND_BLOCK)
+        for body in (data[:-3], data.replace(b'"abcd"', b'abcdef'), data.replace(b'abcd', b'\xff\xfe\xfd\xfc')):
+            with self.assertRaises(wire.WireFormatError):
+                wire.decode(body)
+
+    def test_range_round_trip(self):
+        message = wire.decode(wire.encode([self.block], wire.KIND_RANGE, 5, since_height=1, next_cursor=2))
+        self.assertEqual(message, {'length': 5, 'chain': [self.block], 'peers': [], 'since_height': 1, 'next_cursor': 2})
+        message = wire.decode(wire.encode([self.block], wire.KIND_RANGE, 5, since_height=4))
+        self.assertIsNone(message['next_cursor'])
+
+    def test_ranged_chain_keeps_its_cursor(self):
+        with easy_mining(Blockchain):
+            blockchain = Blockchain()
+            blockchain.create_genesis_block()
+            for voter_hash in 'AB':
+                blockchain.add_new_transaction(vote(voter_hash))
+                blockchain.mine()
+
+        with mock.patch.object(views, 'blockchain', blockchain):
+            response = APIClient().get('/chain/', {'since_height': 1, 'limit': 1}, HTTP_ACCEPT=wire.MEDIA_TYPE)
+
+        self.assertEqual(response['Content-Type'], wire.MEDIA_TYPE)
+        message = wire.decode(response.content)
+        self.assertEqual((message['length'], message['since_height'], message['next_cursor']), (3, 1, 2))
+        self.assertEqual(message['chain'][0]['blockhash'], blockchain.chain[1].blockhash)
+
+    def test_malformed_body_is_a_bad_request(self):
+        data = wire.encode([self.block], wire.KIND_BLOCK).replace(b'abcd', b'\xff\xfe\xfd\xfc')
+        response = APIClient().post('/add_block/', data, content_type=wire.MEDIA_TYPE)
+        self.assertEqual(response.status_code, 400)
+
+
+class EndpointTests(SimpleTestCase):
+    def setUp(self):
+        patcher = easy_mining(Blockchain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blockchain = Blockchain()
+        self.blockchain.create_genesis_block()
+        for voter_hash, candidate in (('A', 'Alice'), ('B', 'Bob'), ('C', 'Alice')):
+            self.blockchain.add_new_transaction(vote(voter_hash, candidate))
+            self.blockchain.mine()
+        patcher = mock.patch.object(views, 'blockchain', self.blockchain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def test_tally(self):
+        self.assertEqual(self.client.get('/tally/').json(),
+                         {'height': 3, 'total_votes': 3, 'tally': {'Alice': 2, 'Bob': 1}})
+
+        self.assertTrue(self.blockchain.replace_suffix(1, []))
+
+        self.assertEqual(self.client.get('/tally/').json(), {'height': 1, 'total_votes': 1, 'tally': {'Alice': 1}})
+
+    def test_block_lookups(self):
+        block = self.blockchain.chain[2]
+
+        self.assertEqual(self.client.get('/block/2/').json(), block.to_dict())
+        self.assertEqual(self.client.get(f'/block/hash/{block.blockhash}/').json(), block.to_dict())
+        self.assertEqual(self.client.get('/block/9/').status_code, 404)
+        self.assertEqual(self.client.get(f'/block/hash/{"f" * 64}/').status_code, 404)
+
+    def test_vote_status(self):
+        self.blockchain.add_new_transaction(vote('D'))
+
+        confirmed = self.client.get('/vote_status/A/').json()
+        self.assertEqual((confirmed['status'], confirmed['block_index'], confirmed['confirmations']), ('confirmed', 1, 3))
+        self.assertEqual(confirmed['blockhash'], self.blockchain.chain[1].blockhash)
+        self.assertEqual(self.client.get('/vote_status/D/').json()['status'], 'pending')
+        self.assertEqual(self.client.get('/vote_status/Z/').json()['status'], 'unknown')
+
+    def test_chain_ranges(self):
+        whole = self.client.get('/chain/').json()
+        self.assertEqual((whole['length'], len(whole['chain'])), (4, 4))
+        self.assertIsNone(whole.get('next_cursor'))
+
+        cursor, blocks = 0, []
+        while cursor is not None:
+            page = self.client.get('/chain/', {'since_height': cursor, 'limit': 3}).json()
+            self.assertEqual(page['since_height'], cursor)
+            blocks += page['chain']
+            cursor = page['next_cursor']
+        self.assertEqual(blocks, whole['chain'])
+
+        self.assertEqual(self.client.get('/chain/', {'since_height': 9}).json()['chain'], [])
+        self.assertEqual(self.client.get('/chain/', {'limit': 0}).status_code, 400)
+
+    def test_headers(self):
+        headers = self.client.get('/headers/', {'since_height': 1, 'limit': 2}).json()
+
+        self.assertEqual([header['index'] for header in headers['headers']], [1, 2])
+        self.assertNotIn('transactions', headers['headers'][0])
+        self.assertEqual(headers['next_cursor'], 3)
+
+    def test_vote_batch_statuses(self):
+        self.blockchain.unconfirmed_transactions.capacity = 2
+        batch = [vote('A'), vote('D'), vote('D'), {'candidate': 'Alice'}, vote('E'), vote('F')]
+
+        with mock.patch.object(views, 'gossip') as gossip:
+            response = self.client.post('/new_transactions/', batch, format='json')
+
+        self.assertEqual(response.json()['accepted'], 2)
+        self.assertEqual([result['status'] for result in response.json()['results']],
+                         ['duplicate_in_chain', 'accepted', 'duplicate_in_pool', 'invalid', 'accepted', 'pool_full'])
+        self.assertEqual([tx['voterhash'] for tx in gossip.forward_transactions.call_args.args[1]], ['D', 'E'])
+        with mock.patch.object(views.TransactionsView, 'MAX_TRANSACTIONS', 1):
+            self.assertEqual(self.client.post('/new_transactions/', batch, format='json').status_code, 400)
+
+    def test_stream_holds_the_whole_chain(self):
+        with mock.patch.object(helpers, 'STREAM_CHUNK_SIZE', 100):
+            response = self.client.get('/chain/stream/')
+            chunks = list(response.streaming_content)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(b''.join(chunks)),
+                         {'length': 4, 'chain': [block.to_dict() for block in self.blockchain.chain], 'peers': []})
+
+    def test_stream_leaves_out_blocks_mined_meanwhile(self):
+        chunks = helpers.stream_chain_json(self.blockchain)
+        first = next(chunks)
+        self.blockchain.add_new_transaction(vote('D'))
+        self.blockchain.mine()
+
+        self.assertEqual(json.loads(first + ''.join(chunks))['length'], 4)
+
+
+class _Response:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class _PeerOverTestClient:
+    """Answer peer calls from a blockchain through the views, recording the paths asked for"""
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.calls = []
+
+    def get(self, path, params=None, headers=None):
+        self.calls.append((path, params))
+        with mock.patch.object(views, 'blockchain', self.blockchain):
+            response = APIClient().get(path, params or {}, HTTP_ACCEPT=(headers or {}).get('Accept', 'application/json'))
+        response.raise_for_status = lambda: None
+        return response
+
+
+class ConsensusTests(SimpleTestCase):
+    def test_only_the_missing_blocks_are_downloaded(self):
+        with easy_mining(Blockchain):
+            peer = Blockchain()
+            peer.create_genesis_block()
+            peer.add_new_transaction(vote('A'))
+            peer.mine()
+            blockchain = Blockchain()
+            blockchain.replace_chain([copy_block(block) for block in peer.chain], verified=True)
+            blockchain.add_peer('http://peer:8000')
+            for voter_hash in 'BC':
+                peer.add_new_transaction(vote(voter_hash))
+                peer.mine()
+            client = _PeerOverTestClient(peer)
+
+            with mock.patch.object(helpers, 'get_client', return_value=client):
+                self.assertTrue(helpers.consensus(blockchain))
+
+        self.assertEqual([block.blockhash for block in blockchain.state.chain], [block.blockhash for block in peer.chain])
+        self.assertEqual(blockchain.state.tally, {'Alice': 3})
+        self.assertIn(('/chain/', {'since_height': 2}), client.calls)
+        self.assertNotIn(('/chain/', None), client.calls)
+
+    def test_slow_and_failing_peers_are_skipped(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def call(node):
+            if node == 'slow':
+                release.wait(5)
+            if node == 'broken':
+                raise ValueError('garbage')
+            return node.upper()
+
+        started = time.monotonic()
+        results = dict(helpers.call_peers(['fast', 'slow', 'broken'], call, deadline=0.2))
+
+        self.assertEqual(results, {'fast': 'FAST'})
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_malformed_tip_skips_the_peer(self):
+        blockchain = Blockchain()
+        blockchain.create_genesis_block()
+        blockchain.add_peer('http://bad:8000')
+        client = mock.Mock()
+        client.get.return_value = _Response({'length': 'oops', 'blockhash': 'x'})
+
+        with mock.patch.object(helpers, 'get_client', return_value=client):
+            self.assertFalse(helpers.consensus(blockchain))
+            self.assertEqual(helpers.sync_with_nodes(blockchain)[0], False)
+
+
+class PeerClientTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('api.peers.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = PeerClient('http://peer:8000')
+        self.addCleanup(self.client.close)
+
+    def test_reads_are_retried(self):
+        answers = [ConnectionError('refused'), mock.Mock(status_code=503), mock.Mock(status_code=200)]
+        with mock.patch.object(self.client._session, 'request', side_effect=answers) as request:
+            self.assertEqual(self.client.get('/tip/').status_code, 200)
+
+        self.assertEqual(request.call_count, 3)
+        request.assert_called_with('GET', 'http://peer:8000/tip/', timeout=PEER_TIMEOUT)
+        stats = self.client.stats()
+        self.assertEqual((stats['requests'], stats['errors'], stats['retries']), (3, 1, 2))
+
+    def test_retries_give_up_after_the_last_try(self):
+        with mock.patch.object(self.client._session, 'request', return_value=mock.Mock(status_code=503)) as request:
+            self.assertEqual(self.client.get('/tip/').status_code, 503)
+        self.assertEqual(request.call_count, PeerClient.RETRIES + 1)
+
+    def test_writes_are_sent_once(self):
+        with mock.patch.object(self.client._session, 'request', side_effect=ConnectionError('refused')) as request:
+            with self.assertRaises(ConnectionError):
+                self.client.post('/add_blocks/', data=b'')
+        self.assertEqual(request.call_count, 1)
+
+
+class GossipTests(SimpleTestCase):
+    def setUp(self):
+        patcher = easy_mining(Blockchain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        blockchain = Blockchain()
+        blockchain.create_genesis_block()
+        gossip = Gossip()
+        patchers = [
+            mock.patch.object(views, 'blockchain', blockchain),
+            mock.patch.object(views, 'gossip', gossip),
+            mock.patch.object(gossip, 'request_pull'),
+            mock.patch.object(gossip, 'forward_blocks'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.blockchain = blockchain
+
+    def test_block_rejected_before_its_parent_is_accepted_later(self):
+        first, first_proof = sealed_block(self.blockchain.last_block, ['A'])
+        first.blockhash = first_proof
+        second, second_proof = sealed_block(first, ['B'])
+        second.blockhash = second_proof
+        client = APIClient()
+
+        self.assertEqual(client.post('/add_block/', second.to_dict(), format='json').status_code, 400)
+        self.assertEqual(client.post('/add_block/', first.to_dict(), format='json').status_code, 201)
+        self.assertEqual(client.post('/add_block/', second.to_dict(), format='json').status_code, 201)
+        self.assertEqual(self.blockchain.state.length, 3)
+
+    def test_block_batch_is_added_whole_or_not_at_all(self):
+        blocks = []
+        previous = self.blockchain.last_block
+        for voter_hash in 'ABCD':
+            block, proof = sealed_block(previous, [voter_hash])
+            block.blockhash = proof
+            blocks.append(block.to_dict())
+            previous = block
+        bad_third, bad_fourth = (dict(block, nonce=block['nonce'] + 1) for block in blocks[2:])
+        client = APIClient()
+
+        response = client.post('/add_blocks/', {'chain': blocks[:2] + [bad_third]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((response.json()['rejected_position'], response.json()['rejected_index']), (2, 3))
+        self.assertEqual(self.blockchain.state.length, 1)
+
+        self.assertEqual(client.post('/add_blocks/', {'chain': blocks[:1]}, format='json').status_code, 201)
+        response = client.post('/add_blocks/', {'chain': blocks[:3] + [bad_fourth]}, format='json')
+        self.assertEqual(response.json()['rejected_position'], 3)
+        self.assertEqual(self.blockchain.state.length, 2)
+
+        response = client.post('/add_blocks/', {'chain': blocks}, format='json')
+        self.assertEqual(response.json()['message'], '3 blocks added to the chain')
+        self.assertEqual(self.blockchain.state.length, 5)
+
+    def test_blocks_are_announced_in_batches(self):
+        for voter_hash in 'ABCDE':
+            self.blockchain.add_new_transaction(vote(voter_hash))
+            self.blockchain.mine()
+        block_dicts = [block.to_dict() for block in self.blockchain.chain[1:]]
+        client = mock.Mock()
+        client.post.return_value = mock.Mock(status_code=201)
+
+        with mock.patch.object(helpers, 'get_client', return_value=client), \
+                mock.patch.object(helpers, 'ANNOUNCE_BATCH_SIZE', 2):
+            helpers.send_blocks_to_node('http://peer:8000', block_dicts)
+
+        sent = [wire.decode(call.kwargs['data'])['chain'] for call in client.post.call_args_list]
+        self.assertEqual(sent, [block_dicts[:2], block_dicts[2:4], block_dicts[4:]])
+
+    def test_votes_are_forwarded_in_batches(self):
+        gossip = Gossip()
+        release = threading.Event()
+        batches = []
+
+        def announce(blockchain, transactions):
+            release.wait()
+            batches.append(len(transactions))
+
+        with mock.patch('api.gossip.announce_new_transactions', announce):
+            for i in range(100):
+                gossip.forward_transaction(None, vote(f'v{i}'))
+            release.set()
+            gossip._executor.submit(lambda: None).result()
+
+        self.assertEqual(sum(batches), 100)
+        self.assertLessEqual(len(batches), 2)
+
+
+class WriterTests(SimpleTestCase):
+    class Counter:
+        def __init__(self):
+            self._writer = ChainWriter()
+            self.threads = set()
+
+        def _publish(self):
+            pass
+
+        @on_writer
+        def record(self):
+            self.threads.add(threading.get_ident())
+            return self.nested()
+
+        @on_writer
+        def nested(self):
+            return threading.get_ident()
+
+        @on_writer
+        def fail(self):
+            raise ValueError('no')
+
+    def test_mutations_run_on_one_thread(self):
+        counter = self.Counter()
+        threads = [threading.Thread(target=counter.record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(counter.threads), 1)
+        self.assertEqual(counter.record(), next(iter(counter.threads)))
+        with self.assertRaises(ValueError):
+            counter.fail()
+
+
+class ServingProcessTests(SimpleTestCase):
+    def test_tests_do_not_start_background_threads(self):
+        self.assertFalse(_is_serving_process())
+
+
+class BlockchainLogTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = easy_mining(BlockchainLog)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.log = BlockchainLog(self.directory)
+        self.log.create_genesis_block()
+
+    def add(self, *voter_hashes):
+        block, proof = sealed_block(self.log.last_block, voter_hashes)
+        self.assertTrue(self.log.add_block(block, proof))
+
+    def segment_files(self, suffix):
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    def test_torn_tail_is_cut_off_on_startup(self):
+        self.add('A')
+        self.add('B')
+        log_path = self.segment_files('.log')[-1]
+        with open(log_path, 'ab') as log:
+            log.write(b'\x40\x00\x00\x00torn')
+
+        reopened = BlockchainLog(self.directory)
+
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual(reopened.already_voted, {'A', 'B'})
+        self.assertEqual(reopened.last_block.blockhash, self.log.last_block.blockhash)
+
+    def test_rollover_to_new_segments(self):
+        with mock.patch.object(BlockchainLog, 'SEGMENT_SIZE', 200):
+            for voter_hash in 'ABCDE':
+                self.add(voter_hash)
+
+        self.assertGreater(len(self.segment_files('.log')), 1)
+        reopened = BlockchainLog(self.directory)
+        self.assertEqual([block.index for block in reopened.blocks()], list(range(6)))
+        self.assertEqual(reopened.block_at(4).transactions[0]['voterhash'], 'D')
+
+    def test_failed_batch_write_leaves_nothing_behind(self):
+        first, first_proof = sealed_block(self.log.last_block, ['A'])
+        first.blockhash = first_proof
+        second, second_proof = sealed_block(first, ['B'])
+        first.blockhash = '0'
+        sizes = [os.path.getsize(path) for path in self.segment_files('.log') + self.segment_files(INDEX_SUFFIX)]
+
+        with mock.patch('api.blockchain_log.os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.log.add_blocks([first, second], [first_proof, second_proof])
+
+        self.assertEqual(len(self.log), 1)
+        self.assertEqual([os.path.getsize(path) for path in self.segment_files('.log') + self.segment_files(INDEX_SUFFIX)],
+                         sizes)
+        self.assertIsNone(self.log.add_blocks([first, second], [first_proof, second_proof]))
+        self.assertEqual(len(BlockchainLog(self.directory)), 3)
+
+
+class BlockchainPersistentTests(TestCase):
+    def setUp(self):
+        patcher = easy_mining(BlockchainPersistent)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blockchain = BlockchainPersistent()
+        self.blockchain.create_genesis_block()
+
+    def test_group_commit_and_restart(self):
+        self.blockchain.add_new_transactions([vote('A'), vote('B')])
+        self.assertTrue(self.blockchain.mine())
+        self.assertIsNone(self.blockchain.add_blocks([], []))
+
+        restarted = BlockchainPersistent()
+
+        self.assertEqual(restarted.last_block.index, 1)
+        self.assertIn('A', restarted.already_voted)
+        self.assertNotIn('C', restarted.already_voted)
+
+    def test_voter_index_is_rebuilt_from_blocks(self):
+        self.blockchain.add_new_transaction(vote('A'))
+        self.blockchain.mine()
+        Voter.objects.all().delete()
+
+        restarted = BlockchainPersistent()
+
+        self.assertIn('A', restarted.already_voted)
+        self.assertEqual(Voter.objects.count(), 1)
+
+    def test_voters_already_indexed_are_not_counted_again(self):
+        self.blockchain.add_new_transactions([vote('A'), vote('B')])
+        self.blockchain.mine()
+        Voter.objects.all().delete()
+        Voter.objects.create(voterhash='B', block_index=0)
+
+        with self.assertLogs('api.voters', 'INFO') as logs:
+            BlockchainPersistent()
+
+        self.assertIn('Indexed 1 voters from block #1 on', logs.output[0])
+        self.assertEqual(Voter.objects.count(), 2)
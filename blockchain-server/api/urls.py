@@ -4,12 +4,24 @@ from . import views
 
 urlpatterns = [
     path('new_transaction/', views.TransactionView.as_view(), name="new_transaction"),
+    path('new_transactions/', views.TransactionsView.as_view(), name="new_transactions"),
     path('chain/', views.ChainView.as_view(), name="chain"),
+    path('chain/stream/', views.ChainStreamView.as_view(), name="chain_stream"),
+    path('tip/', views.TipView.as_view(), name="tip"),
+    path('headers/', views.HeadersView.as_view(), name="headers"),
+    path('block/<int:index>/', views.BlockView.as_view(), name="block"),
+    path('block/hash/<str:blockhash>/', views.BlockView.as_view(), name="block_by_hash"),
+    path('vote_status/<str:voterhash>/', views.VoteStatusView.as_view(), name="vote_status"),
+    path('tally/', views.TallyView.as_view(), name="tally"),
     path('mine_block/', views.MineBlockView.as_view(), name="mine_block"),
+    path('producer_status/', views.ProducerStatusView.as_view(), name="producer_status"),
+    path('peer_stats/', views.PeerStatsView.as_view(), name="peer_stats"),
     path('register_node/', views.RegisterNodeView.as_view(), name="register_node"),
     path('register_with/', views.RegisterWithNodeView.as_view(), name="register_with"),
     path('add_block/', views.AddBlockView.as_view(), name='add_block'),
+    path('add_blocks/', views.AddBlocksView.as_view(), name='add_blocks'),
     path('pending_transactions/', views.PendingTransactionsView.as_view(), name='pending_transactions'),
+    path('vote_proof/<str:voterhash>/', views.VoteProofView.as_view(), name='vote_proof'),
     path('chain_validity/', views.ChainValidityView.as_view(), name='chain_validity'),
     path('reset_blockchain/', views.ResetBlockchainView.as_view(), name='reset_blockchain'),
     path('tamper_block/', views.TamperBlockView.as_view(), name='tamper_block'),
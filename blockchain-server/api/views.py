@@ -1,21 +1,60 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status
+from rest_framework.settings import api_settings
+from rest_framework.exceptions import ValidationError
 
 import datetime
 
 from .serializers import (TransactionSerializer, BlockSerializer, ChainSerializer,
                          NodeRegistrationSerializer, MessageResponseSerializer,
-                         ErrorResponseSerializer)
+                         ErrorResponseSerializer, VoteProofSerializer, TallySerializer,
+                         VoteStatusSerializer, ChainRangeSerializer, HeadersSerializer,
+                         TipSerializer, BlockBatchSerializer)
 
 from .blockchain import Blockchain, Block
-from .helpers import consensus, announce_new_block, create_chain_from_dump, sync_with_nodes
+from .mempool import MempoolFull
+from .merkle import merkle_path
+from .helpers import mine_and_announce, create_chain_from_dump, sync_with_nodes, stream_chain_json
+from .peers import get_client, peer_stats
+from .producer import BlockProducer
+from .gossip import Gossip
+from .snapshot import Snapshotter, load_latest_snapshot
+from .renderers import BlockWireRenderer
+from .parsers import BlockWireParser
 
-# Initialize blockchain
+# Initialize blockchain, serving processes restore the latest snapshot over it
 blockchain = Blockchain()
 blockchain.create_genesis_block()
 
+# Background block producer, started by ApiConfig.ready
+block_producer = BlockProducer(
+    lambda: blockchain,
+    batch_size=settings.BLOCK_PRODUCER_BATCH_SIZE,
+    max_wait=settings.BLOCK_PRODUCER_MAX_WAIT
+)
+
+# Pushes new blocks and transactions on to random peers
+gossip = Gossip()
+
+# Background snapshots, started by ApiConfig.ready
+snapshotter = Snapshotter(
+    lambda: blockchain,
+    directory=settings.SNAPSHOT_DIR,
+    interval=settings.SNAPSHOT_INTERVAL
+)
+
+
+def restore_snapshot() -> None:
+    """Replace the blockchain with the latest snapshot when there is one, called by ApiConfig.ready"""
+    global blockchain
+    restored = load_latest_snapshot(settings.SNAPSHOT_DIR)
+    if restored is not None:
+        blockchain = restored
+
 
 class TransactionView(APIView):
     """
@@ -38,7 +77,13 @@ class TransactionView(APIView):
 
         transaction_data = serializer.validated_data
         transaction_data["timestamp"] = str(datetime.datetime.now())
-        added = blockchain.add_new_transaction(transaction_data)
+        try:
+            added = blockchain.add_new_transaction(transaction_data)
+        except MempoolFull:
+            return Response(
+                ErrorResponseSerializer({'error': 'The vote queue is full, please try again shortly'}).data,
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
 
         # Early return for transaction already in queue
         if not added:
@@ -47,22 +92,243 @@ class TransactionView(APIView):
                 status=status.HTTP_409_CONFLICT
             )
 
+        block_producer.notify()
+        gossip.forward_transaction(blockchain, transaction_data)
+
         return Response(
             MessageResponseSerializer({'message': 'Vote successfully added'}).data,
             status=status.HTTP_201_CREATED
         )
 
 
+class TransactionsView(APIView):
+    """
+    API view for handling a batch of new transaction requests
+
+    Takes a list of votes, or {"transactions": [...]}, and answers with the
+    status of every vote in the order they were sent: accepted,
+    duplicate_in_chain, duplicate_in_pool, invalid or pool_full.
+    """
+    # Largest number of votes accepted in one batch
+    MAX_TRANSACTIONS = 10000
+
+    def post(self, request):
+        items = request.data.get('transactions') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list):
+            return Response(
+                ErrorResponseSerializer({'error': 'Expected a list of transactions'}).data,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if len(items) > self.MAX_TRANSACTIONS:
+            return Response(
+                ErrorResponseSerializer({'error': f'A batch holds at most {self.MAX_TRANSACTIONS} transactions'}).data,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # One serializer validates every vote, an invalid vote only fails itself
+        child = TransactionSerializer()
+        timestamp = str(datetime.datetime.now())
+        results = []
+        transactions = []
+        
+        for item in items:
+            try:
+                transaction_data = child.run_validation(item)
+            except ValidationError as e:
+                results.append({'status': 'invalid', 'error': e.detail})
+                continue
+            
+            voter_hash = transaction_data['voterhash']
+            if voter_hash in blockchain.already_voted:
+                results.append({'voterhash': voter_hash, 'status': 'duplicate_in_chain'})
+                continue
+            
+            transaction_data['timestamp'] = timestamp
+            results.append({'voterhash': voter_hash, 'status': None})
+            transactions.append(transaction_data)
+        
+        added = blockchain.add_new_transactions(transactions)
+        
+        pending_results = (result for result in results if result['status'] is None)
+        for result, was_added in zip(pending_results, added):
+            result['status'] = {True: 'accepted', False: 'duplicate_in_pool', None: 'pool_full'}[was_added]
+        
+        accepted = [transaction for transaction, was_added in zip(transactions, added) if was_added]
+        if accepted:
+            block_producer.notify()
+            gossip.forward_transactions(blockchain, accepted)
+        
+        return Response(
+            {'accepted': len(accepted), 'results': results},
+            status=status.HTTP_200_OK
+        )
+
+
 class ChainView(APIView):
     """
     API view for retrieving the blockchain
+
+    Accepts since_height and limit to return a range of blocks only, along
+    with the next_cursor to pass as since_height for the following range.
+    Without them the whole chain is returned. Nodes may ask for the binary
+    wire format instead of JSON through the Accept header.
     """
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [BlockWireRenderer]
+    
+    # Largest number of blocks returned for one range
+    MAX_LIMIT = 1000
+
     def get(self, request):
-        chain_data = [block.__dict__ for block in blockchain.chain]
+        range_serializer = ChainRangeSerializer(data=request.query_params)
+        if not range_serializer.is_valid():
+            return Response(
+                ErrorResponseSerializer({'error': range_serializer.errors}).data,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Read one state so the range and the total height agree
+        state = blockchain.state
+        chain = state.chain
+        length = state.length
+        
+        if 'since_height' not in request.query_params and 'limit' not in request.query_params:
+            chain_data = [block.to_dict() for block in chain[:length]]
+            serializer = ChainSerializer({
+                "length": length,
+                "chain": chain_data,
+                "peers": list(blockchain.nodes)
+            })
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        
+        since_height = range_serializer.validated_data['since_height']
+        limit = min(range_serializer.validated_data.get('limit', self.MAX_LIMIT), self.MAX_LIMIT)
+        end = min(since_height + limit, length)
+        
+        chain_data = [block.to_dict() for block in chain[since_height:end]]
         serializer = ChainSerializer({
-            "length": len(chain_data),
+            "length": length,
             "chain": chain_data,
-            "peers": list(blockchain.nodes)
+            "peers": list(blockchain.nodes),
+            "since_height": since_height,
+            "next_cursor": end if end < length else None
+        })
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class BlockView(APIView):
+    """
+    API view for retrieving a single block by height or by hash
+    """
+    def get(self, request, index=None, blockhash=None):
+        if blockhash is not None:
+            block = blockchain.block_by_hash(blockhash)
+        else:
+            block = blockchain.block_at(index)
+        
+        if block is None:
+            return Response(
+                {"error": "Block not found"}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        return Response(block.to_dict(), status=status.HTTP_200_OK)
+
+
+class VoteStatusView(APIView):
+    """
+    API view for checking whether a vote is confirmed, pending or unknown
+    """
+    def get(self, request, voterhash):
+        block = blockchain.vote_block(voterhash)
+        
+        if block is not None:
+            vote_status = 'confirmed'
+        elif voterhash in blockchain.unconfirmed_transactions:
+            vote_status = 'pending'
+        else:
+            vote_status = 'unknown'
+        
+        serializer = VoteStatusSerializer({
+            "voterhash": voterhash,
+            "status": vote_status,
+            "block_index": block.index if block else None,
+            "blockhash": block.blockhash if block else None,
+            "confirmations": blockchain.state.last_block.index - block.index + 1 if block else 0
+        })
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class TipView(APIView):
+    """
+    API view for retrieving the height and hash of the last block
+    """
+    def get(self, request):
+        state = blockchain.state
+        last_block = state.last_block
+        serializer = TipSerializer({
+            "length": state.length,
+            "height": last_block.index,
+            "blockhash": last_block.blockhash
+        })
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class HeadersView(APIView):
+    """
+    API view for retrieving a range of block headers, without transactions
+    """
+    # Largest number of headers returned for one range
+    MAX_LIMIT = 2000
+
+    def get(self, request):
+        range_serializer = ChainRangeSerializer(data=request.query_params)
+        if not range_serializer.is_valid():
+            return Response(
+                ErrorResponseSerializer({'error': range_serializer.errors}).data,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        state = blockchain.state
+        chain = state.chain
+        length = state.length
+        since_height = range_serializer.validated_data['since_height']
+        limit = min(range_serializer.validated_data.get('limit', self.MAX_LIMIT), self.MAX_LIMIT)
+        end = min(since_height + limit, length)
+        
+        serializer = HeadersSerializer({
+            "length": length,
+            "headers": [block.header() for block in chain[since_height:end]],
+            "next_cursor": end if end < length else None
+        })
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class ChainStreamView(APIView):
+    """
+    API view for exporting the whole blockchain as a stream
+
+    The JSON document is the same as /chain without a range, but it is
+    written block by block so memory use does not grow with the chain.
+    """
+    def get(self, request):
+        return StreamingHttpResponse(
+            stream_chain_json(blockchain), 
+            content_type='application/json'
+        )
+
+
+class TallyView(APIView):
+    """
+    API view for retrieving the number of confirmed votes per candidate
+    """
+    def get(self, request):
+        state = blockchain.state
+        tally = state.tally
+        serializer = TallySerializer({
+            "height": state.last_block.index,
+            "total_votes": sum(tally.values()),
+            "tally": tally
         })
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -70,40 +336,69 @@ class ChainView(APIView):
 class MineBlockView(APIView):
     """
     API view for mining a new block
+
+    With the background block producer running this is only a hint to seal
+    the pending transactions now, otherwise the block is mined in the request.
     """
     def get(self, request):
         # Early return if mining is already in progress
-        if blockchain.is_mining:
+        if blockchain.is_mining or block_producer.state == 'mining':
             return Response(
                 {"message": "Your block is being mined"}, 
                 status=status.HTTP_200_OK
             )
         
-        result = blockchain.mine()
-        
         # Early return if no transactions to mine
-        if not result:
+        if not blockchain.unconfirmed_transactions:
             return Response(
                 {"message": "No transactions in queue to mine"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        prev_length = len(blockchain.chain)
-        chain_length = len(blockchain.chain)
+        if block_producer.is_running:
+            block_producer.request_mine()
+            return Response(
+                {"message": "Your block is being mined"}, 
+                status=status.HTTP_202_ACCEPTED
+            )
         
-        consensus(blockchain)
+        result = mine_and_announce(blockchain)
         
-        if chain_length == len(blockchain.chain):
-            for i, block in enumerate(blockchain.chain):
-                if i >= prev_length:
-                    announce_new_block(blockchain, block)
+        # Early return if no transactions to mine
+        if not result:
+            return Response(
+                {"message": "No transactions in queue to mine"}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
         
         return Response(
-            {"message": f"Block #{blockchain.last_block.index} is mined. Your vote is now added to the blockchain"},
+            {"message": f"Block #{blockchain.state.last_block.index} is mined. Your vote is now added to the blockchain"},
             status=status.HTTP_201_CREATED
         )
 
 
+class ProducerStatusView(APIView):
+    """
+    API view for retrieving the state of the background block producer
+    """
+    def get(self, request):
+        return Response(
+            block_producer.status(), 
+            status=status.HTTP_200_OK
+        )
+
+
+class PeerStatsView(APIView):
+    """
+    API view for retrieving the connection and latency stats of every peer called
+    """
+    def get(self, request):
+        return Response(
+            {'peers': peer_stats()}, 
+            status=status.HTTP_200_OK
+        )
+
+
 class RegisterNodeView(APIView):
     """
     API view for registering new peer nodes
@@ -119,14 +414,12 @@ class RegisterNodeView(APIView):
         node_address = serializer.validated_data["node_address"]
         
         blockchain.add_peer(node_address[:-1])
-        chain_data = [block.__dict__ for block in blockchain.chain]
         
-        data = {
-            "length": len(chain_data),
-            "chain": chain_data,
-            "peers": list(blockchain.nodes)
-        }
-        return Response(data, status=status.HTTP_200_OK)
+        # The new node bootstraps from our whole chain, stream it rather than build it in memory
+        return StreamingHttpResponse(
+            stream_chain_json(blockchain), 
+            content_type='application/json'
+        )
 
 
 class RegisterWithNodeView(APIView):
@@ -150,16 +443,16 @@ class RegisterWithNodeView(APIView):
         headers = {'Content-Type': "application/json"}
         
         try:
-            response = requests.post(
-                f'{node_address}/register_node/', 
+            response = get_client(node_address).post(
+                '/register_node/', 
                 data=json.dumps(data), 
                 headers=headers
             )
             
             if response.status_code == 200:
-                global blockchain
                 chain_dump = response.json()['chain']
-                blockchain = create_chain_from_dump(chain_dump)
+                # The dump is checked aside, then swapped in by the writer in one go
+                blockchain.replace_chain(create_chain_from_dump(chain_dump).state.chain, verified=True)
                 blockchain.add_peer(node_address)
                 return Response(
                     {"message": "Registration successful"}, 
@@ -181,7 +474,11 @@ class RegisterWithNodeView(APIView):
 class AddBlockView(APIView):
     """
     API view for verifying and adding a block
+
+    The block is sent as JSON or in the binary wire format.
     """
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [BlockWireParser]
+    
     def post(self, request):
         serializer = BlockSerializer(data=request.data)
         if not serializer.is_valid():
@@ -191,48 +488,181 @@ class AddBlockView(APIView):
             )
         
         block_data = serializer.validated_data
+        proof = block_data['blockhash']
+        
+        # Blocks reach us from several peers, only the first accepted copy is processed.
+        # Rejected blocks are not remembered, they may be accepted once their parent arrives
+        if proof in gossip.blocks_seen or blockchain.block_by_hash(proof) is not None:
+            return Response(
+                {"message": "Block already known"}, 
+                status=status.HTTP_200_OK
+            )
         
         block = Block(
             block_data["index"], 
             block_data["transactions"], 
             block_data["timestamp"],
             block_data["previous_hash"], 
-            block_data["nonce"]
+            block_data["nonce"],
+            merkle_root=block_data["merkle_root"]
         )
-        proof = block_data['blockhash']
         
         added = blockchain.add_block(block, proof)
         
         if not added:
+            # A block past our tip means we missed some, fetch them from the peers
+            if block.index >= blockchain.state.length:
+                gossip.request_pull(blockchain)
             return Response(
                 {"error": "The block was discarded by the node"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        gossip.forward_blocks(blockchain, [block])
+        
         return Response(
             {"message": "Block added to the chain"}, 
             status=status.HTTP_201_CREATED
         )
 
 
+class AddBlocksView(APIView):
+    """
+    API view for verifying and adding a batch of consecutive blocks
+
+    The blocks are sent as {"chain": [...]} in JSON or as a chain message in
+    the binary wire format. They are added all together or not at all.
+    """
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [BlockWireParser]
+    
+    # Largest number of blocks accepted in one batch
+    MAX_BLOCKS = 1000
+    
+    def post(self, request):
+        serializer = BlockBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                ErrorResponseSerializer({'error': serializer.errors}).data,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        blocks_data = serializer.validated_data['chain']
+        if len(blocks_data) > self.MAX_BLOCKS:
+            return Response(
+                {"error": f"A batch holds at most {self.MAX_BLOCKS} blocks"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Blocks reach us from several peers, only the ones not yet in the chain are processed.
+        # Only accepted blocks are remembered as seen, when they are forwarded
+        known = 0
+        while known < len(blocks_data) and blockchain.block_by_hash(blocks_data[known]['blockhash']) is not None:
+            known += 1
+        if known == len(blocks_data) or all(block_data['blockhash'] in gossip.blocks_seen for block_data in blocks_data):
+            return Response(
+                {"message": "Blocks already known"}, 
+                status=status.HTTP_200_OK
+            )
+        blocks_data = blocks_data[known:]
+        
+        blocks = [
+            Block(
+                block_data["index"], 
+                block_data["transactions"], 
+                block_data["timestamp"],
+                block_data["previous_hash"], 
+                block_data["nonce"],
+                merkle_root=block_data["merkle_root"]
+            )
+            for block_data in blocks_data
+        ]
+        proofs = [block_data['blockhash'] for block_data in blocks_data]
+        
+        rejected = blockchain.add_blocks(blocks, proofs)
+        
+        if rejected is not None:
+            # A block past our tip means we missed some, fetch them from the peers
+            if blocks[rejected].index >= blockchain.state.length:
+                gossip.request_pull(blockchain)
+            return Response(
+                {
+                    "error": "The blocks were discarded by the node",
+                    "rejected_position": known + rejected,
+                    "rejected_index": blocks[rejected].index
+                }, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        gossip.forward_blocks(blockchain, blocks)
+        
+        return Response(
+            {"message": f"{len(blocks)} blocks added to the chain"}, 
+            status=status.HTTP_201_CREATED
+        )
+
+
 class PendingTransactionsView(APIView):
     """
     API view for retrieving pending transactions
     """
     def get(self, request):
         return Response(
-            blockchain.unconfirmed_transactions, 
+            list(blockchain.unconfirmed_transactions), 
             status=status.HTTP_200_OK
         )
 
 
+class VoteProofView(APIView):
+    """
+    API view for proving that a vote is included in the blockchain
+
+    Returns the header of the block holding the vote and the merkle path
+    from the vote up to the block's merkle root. A client checks the path
+    against the merkle root, then the header against its blockhash, without
+    downloading the chain.
+    """
+    def get(self, request, voterhash):
+        block = blockchain.vote_block(voterhash)
+        
+        # Early return if the vote is not in the chain
+        if block is None:
+            return Response(
+                {"error": "No vote found in the blockchain for this voter"}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        if block.merkle_root is None:
+            return Response(
+                {"error": f"Block #{block.index} holding this vote has no merkle root"}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        for position, transaction in enumerate(block.transactions):
+            if transaction.get('voterhash') == voterhash:
+                serializer = VoteProofSerializer({
+                    "block_header": block.header(),
+                    "transaction": transaction,
+                    "transaction_index": position,
+                    "merkle_path": merkle_path(block.transactions, position)
+                })
+                return Response(serializer.data, status=status.HTTP_200_OK)
+        
+        return Response(
+            {"error": "No vote found in the blockchain for this voter"}, 
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+
 class ChainValidityView(APIView):
     """
     API view for checking if the chain has been tampered with
     """
     def get(self, request):
         try:
-            result = blockchain.check_chain_validity(blockchain.chain)
+            # Only new and edited blocks are rehashed unless a full audit is asked for,
+            # which rehashes every block from its fields and so also catches edits nested in a transaction
+            full = request.query_params.get('full', '').lower() in ('1', 'true')
+            result = blockchain.verify_chain(full=full)
             
             if result:
                 return Response(
@@ -258,8 +688,7 @@ class ResetBlockchainView(APIView):
     """
     def get(self, request):
         try:
-            blockchain.chain = []
-            blockchain.create_genesis_block()
+            blockchain.reset()
             return Response(
                 {"message": "Reset successful"}, 
                 status=status.HTTP_200_OK
@@ -276,14 +705,16 @@ class TamperBlockView(APIView):
     API view for tampering with a block (for testing purposes)
     """
     def get(self, request):
-        if len(blockchain.chain) <= 1:
+        state = blockchain.state
+        if state.length <= 1:
             return Response(
                 {"error": "No blocks in blockchain to tamper with"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        block = blockchain.chain[1]
-        block.transactions[0]['candidate'] = 'Hacker'
+        # The edit runs on the writer and replaces the transactions, so the next check sees it
+        transactions = state.chain[1].transactions
+        blockchain.update_block(1, transactions=[dict(transactions[0], candidate='Hacker')] + transactions[1:])
         
         return Response(
             {"message": "Blockchain hacked successfully"}, 
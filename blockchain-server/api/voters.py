@@ -0,0 +1,115 @@
+import logging
+import math
+import threading
+from hashlib import blake2b
+from typing import Iterable, List
+
+from .models import Block as BlockModel, Voter
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    Fixed size set of strings that may answer a false "present" but never a false "absent"
+
+    The bit array is sized once for capacity items at the given false
+    positive rate. Adding more items than that keeps every answer correct
+    for absent items, only the false positive rate grows.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        """Get the bits of a key by double hashing one 128 bit digest"""
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class VoterIndex:
+    """
+    Set of the voters whose vote is on the chain, stored in the Voter table
+
+    A Bloom filter in front of the table answers for voters that did not
+    vote without any query, only its hits are looked up in the table. Rows
+    are written in the same transaction as their block, so the table always
+    matches the stored chain and survives restarts, while memory stays at
+    the size of the filter however many voters there are.
+    """
+    # Blocks read at a time while catching up with the chain
+    CATCH_UP_CHUNK_SIZE = 500
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        Args:
+            capacity: Number of voters the filter is sized for
+            error_rate: Share of absent voters the filter lets through to the table
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filter = BloomFilter(capacity, error_rate)
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        Index the blocks stored since the last indexed vote and fill the filter
+
+        Only the blocks above the highest indexed vote are read, so a node
+        upgraded from a chain without the table indexes it once and later
+        starts only look at the few blocks mined after the last vote.
+        """
+        last = Voter.objects.order_by('-block_index').values_list('block_index', flat=True).first()
+        start = 0 if last is None else last + 1
+        # bulk_create reports the rows it tried, voters already in the table are skipped
+        before = Voter.objects.count()
+
+        blocks = []
+        for block in BlockModel.objects.filter(index__gte=start).iterator(chunk_size=self.CATCH_UP_CHUNK_SIZE):
+            blocks.append(block)
+            if len(blocks) == self.CATCH_UP_CHUNK_SIZE:
+                Voter.objects.bulk_create(self.rows_for(blocks), ignore_conflicts=True)
+                blocks = []
+        if blocks:
+            Voter.objects.bulk_create(self.rows_for(blocks), ignore_conflicts=True)
+
+        self._filter = BloomFilter(self.capacity, self.error_rate)
+        count = 0
+        for voter_hash in Voter.objects.values_list('voterhash', flat=True).iterator(chunk_size=10000):
+            self._filter.add(voter_hash)
+            count += 1
+        if count > before:
+            logger.info(f"Indexed {count - before} voters from block #{start} on")
+        if count > self.capacity:
+            logger.warning(f"{count} voters exceed the filter capacity of {self.capacity}, more lookups will hit the table")
+
+    @staticmethod
+    def rows_for(blocks: List[BlockModel]) -> List[Voter]:
+        """Get the rows to write along with blocks"""
+        return [
+            Voter(voterhash=tx['voterhash'], block_index=block.index)
+            for block in blocks
+            for tx in block.transactions
+            if 'voterhash' in tx
+        ]
+
+    def add(self, voter_hash: str) -> None:
+        """Add a voter whose row was written to the filter"""
+        with self._lock:
+            self._filter.add(voter_hash)
+
+    def __contains__(self, voter_hash: str) -> bool:
+        if voter_hash not in self._filter:
+            return False
+        return Voter.objects.filter(voterhash=voter_hash).exists()
@@ -0,0 +1,310 @@
+import json
+from typing import List, Dict, Any, Optional, Tuple
+
+# Compact binary encoding of blocks exchanged between nodes
+#
+# message  := MAGIC version kind varint(length) [range] varint(peer count) string*
+#             varint(candidate count) string* varint(block count) record*
+# range    := varint(since_height) varint(next_cursor + 1, 0 for none), in KIND_RANGE messages only
+# record   := varint(record size) block
+# block    := varint(index) value(timestamp) hash(previous_hash) varint(nonce)
+#             hash(blockhash) hash(merkle_root) varint(transaction count) transaction*
+# transaction := varint(flags) [varint(candidate id)] [hash(voterhash)]
+#                [value(timestamp)] [string(JSON of any other fields)]
+#
+# Hashes that are 64 lowercase hex characters travel as their 32 raw bytes,
+# candidate names are sent once per message and referred to by position.
+
+MEDIA_TYPE = 'application/x-securevote-blocks'
+MAGIC = b'SVB'
+VERSION = 1
+
+# What a message carries
+KIND_CHAIN = 1
+KIND_BLOCK = 2
+# A range of a chain, along with where it starts and the cursor to the next range
+KIND_RANGE = 3
+
+# Tags of hash fields
+HASH_RAW = 0
+HASH_STRING = 1
+HASH_NONE = 2
+
+# Tags of timestamp values
+VALUE_INT = 0
+VALUE_STRING = 1
+
+# Fields present in a transaction
+TX_CANDIDATE = 1
+TX_VOTERHASH = 2
+TX_TIMESTAMP = 4
+TX_EXTRA = 8
+
+
+class WireFormatError(ValueError):
+    """Raised when a message cannot be decoded"""
+    pass
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    if value < 0:
+        raise ValueError(f"Cannot encode negative varint {value}")
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_string(out: bytearray, value: str) -> None:
+    data = value.encode()
+    _write_varint(out, len(data))
+    out += data
+
+
+def _write_hash(out: bytearray, value: Optional[str]) -> None:
+    if value is None:
+        out.append(HASH_NONE)
+        return
+    if len(value) == 64:
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            raw = None
+        # Only lowercase hex decodes back to the exact same string
+        if raw is not None and raw.hex() == value:
+            out.append(HASH_RAW)
+            out += raw
+            return
+    out.append(HASH_STRING)
+    _write_string(out, value)
+
+
+def _write_value(out: bytearray, value: Any) -> None:
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        out.append(VALUE_INT)
+        _write_varint(out, value)
+    else:
+        out.append(VALUE_STRING)
+        _write_string(out, str(value))
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def byte(self) -> int:
+        if self.position >= len(self.data):
+            raise WireFormatError("Message is truncated")
+        value = self.data[self.position]
+        self.position += 1
+        return value
+
+    def raw(self, size: int) -> bytes:
+        end = self.position + size
+        if end > len(self.data):
+            raise WireFormatError("Message is truncated")
+        value = self.data[self.position:end].tobytes()
+        self.position = end
+        return value
+
+    def varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def string(self) -> str:
+        return self.raw(self.varint()).decode()
+
+    def hash(self) -> Optional[str]:
+        tag = self.byte()
+        if tag == HASH_RAW:
+            return self.raw(32).hex()
+        if tag == HASH_STRING:
+            return self.string()
+        if tag == HASH_NONE:
+            return None
+        raise WireFormatError(f"Unknown hash tag {tag}")
+
+    def value(self) -> Any:
+        tag = self.byte()
+        if tag == VALUE_INT:
+            return self.varint()
+        if tag == VALUE_STRING:
+            return self.string()
+        raise WireFormatError(f"Unknown value tag {tag}")
+
+
+def _encode_transaction(out: bytearray, transaction: Dict, candidates: Dict[str, int]) -> None:
+    known = {}
+    extra = {}
+    for key, value in transaction.items():
+        if key in ('candidate', 'voterhash', 'timestamp') and isinstance(value, str):
+            known[key] = value
+        else:
+            extra[key] = value
+
+    flags = ((TX_CANDIDATE if 'candidate' in known else 0) | (TX_VOTERHASH if 'voterhash' in known else 0) |
+             (TX_TIMESTAMP if 'timestamp' in known else 0) | (TX_EXTRA if extra else 0))
+    _write_varint(out, flags)
+
+    if 'candidate' in known:
+        _write_varint(out, candidates.setdefault(known['candidate'], len(candidates)))
+    if 'voterhash' in known:
+        _write_hash(out, known['voterhash'])
+    if 'timestamp' in known:
+        _write_value(out, known['timestamp'])
+    if extra:
+        _write_string(out, json.dumps(extra, sort_keys=True))
+
+
+def _decode_transaction(reader: _Reader, candidates: List[str]) -> Dict:
+    flags = reader.varint()
+    transaction = {}
+    if flags & TX_CANDIDATE:
+        position = reader.varint()
+        if position >= len(candidates):
+            raise WireFormatError(f"Unknown candidate {position}")
+        transaction['candidate'] = candidates[position]
+    if flags & TX_VOTERHASH:
+        transaction['voterhash'] = reader.hash()
+    if flags & TX_TIMESTAMP:
+        transaction['timestamp'] = reader.value()
+    if flags & TX_EXTRA:
+        transaction.update(json.loads(reader.string()))
+    return transaction
+
+
+def _encode_block(block: Dict, candidates: Dict[str, int]) -> bytearray:
+    out = bytearray()
+    _write_varint(out, block['index'])
+    _write_value(out, block['timestamp'])
+    _write_hash(out, block['previous_hash'])
+    _write_varint(out, block['nonce'])
+    _write_hash(out, block.get('blockhash', '0'))
+    _write_hash(out, block.get('merkle_root'))
+    _write_varint(out, len(block['transactions']))
+    for transaction in block['transactions']:
+        _encode_transaction(out, transaction, candidates)
+    return out
+
+
+def _decode_block(reader: _Reader, candidates: List[str]) -> Dict:
+    block = {
+        'index': reader.varint(),
+        'timestamp': reader.value(),
+        'previous_hash': reader.hash(),
+        'nonce': reader.varint(),
+        'blockhash': reader.hash(),
+        'merkle_root': reader.hash(),
+    }
+    block['transactions'] = [_decode_transaction(reader, candidates) for _ in range(reader.varint())]
+    return block
+
+
+def encode(blocks: List[Dict], kind: int = KIND_CHAIN, length: Optional[int] = None,
+           peers: Tuple[str, ...] = (), since_height: int = 0, next_cursor: Optional[int] = None) -> bytes:
+    """
+    Encode blocks into a binary message
+
+    Args:
+        blocks: The blocks as dicts, with the same fields as in the JSON API
+        kind: KIND_CHAIN for a list of blocks, KIND_BLOCK for a single one,
+            KIND_RANGE for a range of a chain
+        length: Chain length to report, the number of blocks by default
+        peers: Peer addresses to send along
+        since_height: Height of the first block of a range
+        next_cursor: Height of the first block of the next range, None after the last one
+
+    Returns:
+        bytes: The encoded message
+    """
+    candidates: Dict[str, int] = {}
+    records = [_encode_block(block, candidates) for block in blocks]
+
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out.append(kind)
+    _write_varint(out, len(blocks) if length is None else length)
+    if kind == KIND_RANGE:
+        _write_varint(out, since_height)
+        _write_varint(out, 0 if next_cursor is None else next_cursor + 1)
+    _write_varint(out, len(peers))
+    for peer in peers:
+        _write_string(out, peer)
+    _write_varint(out, len(candidates))
+    for candidate in candidates:
+        _write_string(out, candidate)
+    _write_varint(out, len(records))
+    for record in records:
+        _write_varint(out, len(record))
+        out += record
+    return bytes(out)
+
+
+def decode(data: bytes) -> Dict[str, Any]:
+    """
+    Decode a binary message
+
+    Args:
+        data: The encoded message
+
+    Returns:
+        Dict[str, Any]: For a KIND_BLOCK message the block itself, otherwise
+        a dict with the length, chain and peers keys of the JSON API, and
+        the since_height and next_cursor keys for a KIND_RANGE message
+
+    Raises:
+        WireFormatError: If the message is malformed or of another version
+    """
+    try:
+        return _decode(data)
+    except WireFormatError:
+        raise
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        # Bad UTF-8, bad JSON or a wrong candidate id inside an otherwise well framed message
+        raise WireFormatError(f"Malformed message: {str(e)}") from e
+
+
+def _decode(data: bytes) -> Dict[str, Any]:
+    """Decode a binary message, see decode"""
+    if data[:len(MAGIC)] != MAGIC:
+        raise WireFormatError("Not a block message")
+
+    reader = _Reader(data)
+    reader.raw(len(MAGIC))
+    version = reader.byte()
+    if version != VERSION:
+        raise WireFormatError(f"Unsupported message version {version}")
+    kind = reader.byte()
+
+    length = reader.varint()
+    if kind == KIND_RANGE:
+        since_height = reader.varint()
+        next_cursor = reader.varint() - 1
+    peers = [reader.string() for _ in range(reader.varint())]
+    candidates = [reader.string() for _ in range(reader.varint())]
+
+    blocks = []
+    for _ in range(reader.varint()):
+        size = reader.varint()
+        end = reader.position + size
+        blocks.append(_decode_block(reader, candidates))
+        if reader.position != end:
+            raise WireFormatError("Block record size does not match its content")
+
+    if kind == KIND_BLOCK:
+        if len(blocks) != 1:
+            raise WireFormatError("Block message must hold exactly one block")
+        return blocks[0]
+
+    message = {'length': length, 'chain': blocks, 'peers': peers}
+    if kind == KIND_RANGE:
+        message['since_height'] = since_height
+        message['next_cursor'] = next_cursor if next_cursor >= 0 else None
+    return message
@@ -0,0 +1,44 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class ChainWriter:
+    """
+    Single thread that runs every mutation of a blockchain, one at a time
+
+    Callers on any thread hand their mutation over and wait for its result,
+    so the chain and the mempool only ever change on the writer thread and
+    need no lock of their own. A mutation that calls another one runs it in
+    place rather than queueing behind itself.
+    """
+
+    def __init__(self, name: str = 'chain-writer'):
+        self._thread_id: Optional[int] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name, initializer=self._started)
+
+    def _started(self) -> None:
+        self._thread_id = threading.get_ident()
+
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run fn on the writer thread and wait for its result, its exception is raised here"""
+        if threading.get_ident() == self._thread_id:
+            return fn(*args, **kwargs)
+        return self._executor.submit(fn, *args, **kwargs).result()
+
+
+def on_writer(method: Callable) -> Callable:
+    """
+    Run a blockchain method on the blockchain's writer thread
+
+    The blockchain publishes a new read state once the method is done.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        def write():
+            result = method(self, *args, **kwargs)
+            self._publish()
+            return result
+        return self._writer.call(write)
+    return wrapper
@@ -123,3 +123,30 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Worker processes used for the nonce search and for validating long chains,
+# 1 mines in the calling process without starting a process pool
+
+MINING_WORKERS = 1
+
+
+# Background block producer, started from ApiConfig.ready
+
+BLOCK_PRODUCER_ENABLED = True
+
+# Seal a block once this many transactions are pending...
+BLOCK_PRODUCER_BATCH_SIZE = 100
+
+# ...or once the oldest pending transaction has waited this many seconds
+BLOCK_PRODUCER_MAX_WAIT = 5.0
+
+
+# Snapshots of the node, restored on startup
+
+SNAPSHOT_ENABLED = True
+
+SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+
+# Seconds between two snapshots
+SNAPSHOT_INTERVAL = 30.0
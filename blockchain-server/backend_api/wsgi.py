@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_api.settings')
+# This process serves requests, so the app starts its background threads
+os.environ.setdefault('API_SERVING_PROCESS', '1')
 
 application = get_wsgi_application()
@@ -149,10 +149,10 @@ TRANSACTIONS = [
 ]
 
 def create_new_transactions():
-    for i in range(len(TRANSACTIONS)):
-        response = requests.post("http://127.0.0.1:5000/new_transaction/", json=TRANSACTIONS[i], headers={'Content-type': 'application/json'})
-        print(f"Success: #{i}")
-        requests.get("http://127.0.0.1:5000/mine_block/")
+    response = requests.post("http://127.0.0.1:5000/new_transactions/", json=TRANSACTIONS, headers={'Content-type': 'application/json'})
+    for i, result in enumerate(response.json()['results']):
+        print(f"{result['status']}: #{i}")
+    requests.get("http://127.0.0.1:5000/mine_block/")
 
 
 create_new_transactions()
\ No newline at end of file
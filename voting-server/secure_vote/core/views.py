@@ -314,17 +314,8 @@ def sync_with_honest_nodes(request):
 
 
 def fetch_votes_and_count():
-    vote_count = {}
-    response = requests.get(f'{BLOCKCHAIN_NODE_ADDRESS}/chain')
-    chain_json = response.json()['chain']
-
-    for block in chain_json:
-        for transaction in block['transactions']:
-            if transaction['candidate'] in vote_count:
-                vote_count[transaction['candidate']] += 1
-            else:
-                vote_count[transaction['candidate']] = 1
-    return vote_count
+    response = requests.get(f'{BLOCKCHAIN_NODE_ADDRESS}/tally/')
+    return response.json()['tally']
 
 
 @login_required(login_url='login')